@@ -9,6 +9,25 @@ import math
 from environment import Agent, Environment
 from planner import RoutePlanner
 from simulator import Simulator
+from qtable import QTable, DenseQTable, StateEncoder, save_table, load_table
+
+try:
+    import numpy as np
+    from replay import ReplayBuffer
+except ImportError:
+    np = None  # the dense Q-table and replay buffer are unavailable without NumPy
+
+
+# Exploration factor decay functions, by name
+# Each maps (trial, n_trials) to epsilon for that trial
+epsilon_schedules = {
+    'linear':      lambda trial, n_trials: 1 - float(trial - 1) / n_trials, # linear 1 to 0
+    'geometric':   lambda trial, n_trials: 0.9 ** trial,
+    'inverse':     lambda trial, n_trials: 1.0 / trial,
+    'inverse_sq':  lambda trial, n_trials: 1.0 / trial ** 2,
+    'exponential': lambda trial, n_trials: math.exp(-0.1 * (trial - 1)),
+    'cosine':      lambda trial, n_trials: math.cos(math.pi / 2 * float(trial) / n_trials),
+}
 
 
 class LearningAgent(Agent):
@@ -17,11 +36,23 @@ class LearningAgent(Agent):
     This is the object you will be modifying.
     """
 
-    def __init__(self, env, learning=False, epsilon=1.0, alpha=0.5):
+    def __init__(self, env, learning=False, epsilon=1.0, alpha=0.5, decay='cosine', alpha_decay='linear',
+                 dense=False, replay=0, batch_size=128, Q=None):
         """
-        learning - Whether the agent is expected to learn
-        epsilon  - Random exploration factor, a probability, 0.0-1.0
-        alpha    - Learning rate, 0.0-1.0
+        learning    - Whether the agent is expected to learn
+        epsilon     - Random exploration factor, a probability, 0.0-1.0
+        alpha       - Learning rate, 0.0-1.0
+        decay       - Name of the epsilon decay function, see epsilon_schedules
+        alpha_decay - 'linear' to decay alpha from 1 to 0 over n_trials,
+                      or 'constant' to keep the given alpha
+        dense       - Whether to keep the Q-table in a NumPy array (see qtable.DenseQTable)
+        replay      - Number of past transitions to keep for experience replay, 0 for none;
+                      replay uses the dense Q-table
+        batch_size  - Number of past transitions to learn from again at the start
+                      of each training trial, when replay is on
+        Q           - Q-table of another agent to learn into, e.g. for a fleet of cabs
+                      (see Environment.add_cab); by default the agent has its own.
+                      With replay, it must be a DenseQTable
         """
         super(LearningAgent, self).__init__(env)     # Set the agent in the evironment
         self.planner = RoutePlanner(self.env, self)  # Create a route planner
@@ -29,9 +60,11 @@ class LearningAgent(Agent):
 
         # Set parameters of the learning agent
         self.learning = learning # Whether the agent is expected to learn
-        self.Q = dict()          # Create a Q-table which will be a dictionary of tuples
+        self.Q = None            # Q-table, created below once the states are defined
         self.epsilon = epsilon   # Random exploration factor
         self.alpha = alpha       # Learning factor
+        self.decay = decay       # Epsilon decay function
+        self.alpha_decay = alpha_decay # Learning factor decay
         self.coverage = 0        # Percent of state-action space covered
 
         ###########
@@ -51,6 +84,23 @@ class LearningAgent(Agent):
         self.n_states = 2 * 3 * 4 * 4  # 96
         self.n_state_actions = self.n_states * len(self.valid_actions)  # 384
 
+        # Create the Q-table and replay buffer
+        if (dense or replay) and np is None:
+            print "LearningAgent.__init__(): Unable to import numpy; using a dictionary Q-table without replay."
+            dense = replay = False
+        self.buffer = ReplayBuffer(replay) if replay else None
+        self.batch_size = batch_size
+        dense = dense or replay
+        encoder = StateEncoder(self.states, self.state_domains())
+        if Q is not None:
+            if replay and not isinstance(Q, DenseQTable):
+                raise ValueError("LearningAgent.__init__(): replay needs a DenseQTable, got {}".format(type(Q).__name__))
+            self.Q = Q
+        elif dense:
+            self.Q = DenseQTable(encoder, self.valid_actions)
+        else:
+            self.Q = QTable(self.valid_actions, encoder)
+
         ###########
         ## TO DO ##
         ###########
@@ -60,6 +110,23 @@ class LearningAgent(Agent):
 
 
 
+    def save_Q(self, filename):
+        """
+        Save the Q-table to a binary .npy file (see qtable.save_table).
+        """
+
+        save_table(self.Q, filename)
+
+
+    def load_Q(self, filename):
+        """
+        Load a Q-table saved by save_Q, e.g. to warm-start training or to
+        test a trained policy without training again.
+        """
+
+        load_table(self.Q, filename)
+
+
     def reset(self, destination=None, testing=False):
         """
         Reset the agent's state.
@@ -86,14 +153,8 @@ class LearningAgent(Agent):
 
             # optimized
             trial = self.trial
-            frac = float(trial)/self.n_trials
             frac0 = float(trial-1)/self.n_trials
-            # self.epsilon = 1-frac0 # linear 1 to 0
-            # self.epsilon = 0.9**trial
-            # self.epsilon = 1.0 / trial
-            # self.epsilon = 1.0 / trial**2
-            # self.epsilon = math.exp(-0.1*(trial-1))
-            self.epsilon = math.cos(math.pi/2 * frac)
+            self.epsilon = epsilon_schedules[self.decay](trial, self.n_trials)
 
             # make sure we stay in bounds 0 to 1
             if self.epsilon > 1.0:
@@ -104,11 +165,26 @@ class LearningAgent(Agent):
             # adjust learning rate alpha
             # self.alpha = 1.0 if frac < 0.8 else 0.1
             # self.alpha = self.epsilon
-            self.alpha = 1-frac0 # linear 1 to 0
+            if self.alpha_decay == 'linear':
+                self.alpha = 1-frac0 # linear 1 to 0
+
+            # learn again from past experience, before each training trial only
+            if self.learning and self.buffer is not None and len(self.buffer):
+                self.replay()
 
             self.trial += 1
 
 
+    def replay(self):
+        """
+        Learn from a batch of transitions drawn from the replay buffer,
+        in one vectorized update of the Q-table.
+        """
+
+        states, actions, rewards = self.buffer.sample(self.batch_size)
+        self.Q.batch_update(states, actions, rewards, self.alpha)
+
+
     def build_state(self):
         """
         Build a state object for the agent.
@@ -133,6 +209,7 @@ class LearningAgent(Agent):
             'right':    senses['right'],
             'deadline': self.env.get_deadline(self),
         }
+        self.next_waypoint = inputs['waypoint'] # reused by choose_action and the environment
 
         # Build a state object using the states specified in agent initialization.
         # e.g. if self.states was set to ('light', 'oncoming') in __init__,
@@ -153,6 +230,24 @@ class LearningAgent(Agent):
         return state
 
 
+    def state_domains(self):
+        """
+        Return the possible values of every state feature, by name.
+        Used to encode states as integers for the dense Q-table.
+        """
+
+        env = self.env
+        max_distance = env.grid_size[0] // 2 + env.grid_size[1] // 2 # farthest intersection on the torus
+        return {
+            'waypoint': self.valid_actions, # None only at the destination
+            'light':    ['red', 'green'],
+            'oncoming': self.valid_actions,
+            'left':     self.valid_actions,
+            'right':    self.valid_actions,
+            'deadline': range(env.hard_time_limit, max_distance * 5 + 1), # see Environment.reset
+        }
+
+
     def get_maxQ(self, state):
         """
         Find the maximum Q-value of all actions based on the 'state' the smartcab is in.
@@ -164,8 +259,7 @@ class LearningAgent(Agent):
         ###########
         # Calculate the maximum Q-value of all actions for a given state
         # maxQ = None
-        d = self.Q[state]
-        maxQ = max(d.values())
+        maxQ = self.Q.max_value(state)
         return maxQ
 
 
@@ -182,16 +276,7 @@ class LearningAgent(Agent):
         # If it is not, create a new dictionary for that state
         #   Then, for each action available, set the initial Q-value to None
         if self.learning:
-            if not state in self.Q:
-                data = dict()
-                #. use self.states eg
-                # for state_name in self.states:
-                    # data[state_name] = None
-                data[None]      = None
-                data['forward'] = None
-                data['right']   = None
-                data['left']    = None
-                self.Q[state] = data
+            self.Q.create_state(state)
 
 
     def choose_action(self, state):
@@ -201,8 +286,8 @@ class LearningAgent(Agent):
         """
 
         # Set the agent state and default action
+        # (next_waypoint was set by build_state)
         self.state = state
-        self.next_waypoint = self.planner.next_waypoint()
         # action = None
 
         ###########
@@ -215,13 +300,9 @@ class LearningAgent(Agent):
             action = random.choice(self.valid_actions)
         else:
             # This is called the Epsilon-Greedy Selection method
-            data = self.Q[state]
             if random.random() < self.epsilon:
                 # choose from actions with None for reward value
-                actions = []
-                for action in data:
-                    if data[action] is None:
-                        actions.append(action)
+                actions = self.Q.unvisited_actions(state)
                 if actions:
                     action = random.choice(actions)
                 else:
@@ -234,14 +315,8 @@ class LearningAgent(Agent):
                     # value = data[action] or 0
                     # if value > maxQ:
                         # maxQ = value
-                # find maxQ value
-                maxQ = max(data.values()) or 0
-                # check for ties
-                actions = []
-                for action in data:
-                    value = data[action] or 0
-                    if value == maxQ:
-                        actions.append(action)
+                # find the actions tied for the max Q value (kept up to date by learn)
+                actions = self.Q.greedy_actions(state)
                 # pick an action from max value actions
                 action = random.choice(actions)
 
@@ -265,9 +340,13 @@ class LearningAgent(Agent):
         # qnew = (1-alpha)*qold + alpha*[reward + gamma * qmax]
 
         # self.Q[state][action] = reward # this worked fairly well - ie alpha always =1
-        Q = self.Q[state][action] or 0
+        Q = self.Q.get_value(state, action) or 0
         Qnew = (1-self.alpha)*Q + self.alpha * reward
-        self.Q[state][action] = Qnew
+        self.Q.set_value(state, action, Qnew)
+
+        # keep the transition for replay
+        if self.buffer is not None:
+            self.buffer.add(self.Q.encoder.encode(state), self.Q.action_codes[action], reward)
 
 
     def update(self):
@@ -283,13 +362,8 @@ class LearningAgent(Agent):
         self.learn(state, action, reward)   # Q-learn
 
         # Calculate coverage of state-action space
-        #. do this elsewhere?
-        n_seen = 0
-        for rewards in self.Q.values():
-            for reward in rewards.values():
-                if not reward is None:
-                    n_seen += 1
-        self.coverage = float(n_seen) / self.n_state_actions
+        # The Q-table counts state-action pairs as they get their first value
+        self.coverage = float(self.Q.n_visited) / self.n_state_actions
 
 
 def run():
@@ -313,6 +387,11 @@ def run():
     #   learning   - set to True to force the driving agent to use Q-learning
     #   epsilon    - continuous value for the exploration factor, default is 1
     #   alpha      - continuous value for the learning rate, default is 0.5
+    #   decay      - name of the epsilon decay function, default is 'cosine'
+    #   alpha_decay - 'linear' (default) or 'constant' learning rate over the trials
+    #   dense      - set to True to keep the Q-table in a NumPy array
+    #   replay     - number of past transitions to keep and learn from again, default is 0 (off)
+    #   batch_size - number of past transitions replayed before each training trial, default is 128
     # agent = env.create_agent(LearningAgent)
     # agent = env.create_agent(LearningAgent, learning=True)
     agent = env.create_agent(LearningAgent, learning=True, alpha=0.5)
@@ -325,6 +404,12 @@ def run():
     # env.set_primary_agent(agent)
     env.set_primary_agent(agent, enforce_deadline=True)
 
+    # Fleet mode: more cabs learning into the same Q-table, each on its own trip
+    # for i in range(4):
+    #     cab = env.create_agent(LearningAgent, learning=True, alpha=0.5, Q=agent.Q)
+    #     cab.n_trials = 250
+    #     env.add_cab(cab)
+
     ##############
     # Create the simulation
     # Flags:
@@ -332,6 +417,11 @@ def run():
     #   display      - set to False to disable the GUI if PyGame is enabled
     #   log_metrics  - set to True to log trial and simulation results to /logs
     #   optimized    - set to True to change the default log file name
+    #   headless     - set to True to run steps back to back and report steps/sec
+    #   profile      - set to True to report time spent in each phase, per trial and per run
+    #   log_binary   - set to True to also write the trial log as NumPy columns (.npz)
+    #   print_limit  - number of Q-table rows to print at the end, None for all, 0 for none
+    #   log_async    - set to True to write the trial log from a background thread
     # sim = Simulator(env)
     # sim = Simulator(env, update_delay=0, log_metrics=True, display=False) # use for unoptimized dataset
     sim = Simulator(env, update_delay=0, log_metrics=True, optimized=True, display=False)
@@ -341,6 +431,11 @@ def run():
     # Flags:
     #   tolerance    - epsilon tolerance before beginning testing, default is 0.05
     #   n_test       - discrete number of testing trials to perform, default is 0
+    #   train        - set to False to only run testing trials
+    #   monitor      - a convergence.ConvergenceMonitor, to end training once the Q-table converges
+    # To warm-start from a saved Q-table, or test it without training again:
+    # agent.load_Q(os.path.join("logs", "sim_improved-learning.npy"))
+    # sim.run(n_test=40, train=False)
     agent.n_trials = 250
     sim.run(n_test=40)
 
@@ -0,0 +1,300 @@
+
+"""
+Array-backed agent states for the smartcab environment.
+Each agent's location, heading, destination, deadline and next waypoint
+live in NumPy arrays indexed by agent id, so whole fleets of dummies can
+be moved with a handful of array operations.
+"""
+
+import numpy as np
+
+
+class AgentStateArrays(object):
+    """
+    Struct-of-arrays store of agent states, indexed by agent id.
+    Headings and waypoints are kept as indices into the environment's
+    valid_headings and valid_actions lists.
+    """
+
+    def __init__(self, bounds, grid_size, valid_headings, valid_actions, capacity=128):
+        """
+        bounds         - the environment bounds (min x, min y, max x, max y)
+        grid_size      - discrete number of intersections (columns, rows)
+        valid_headings - heading vectors, in the order of the heading codes
+        valid_actions  - actions, in the order of the waypoint codes
+        capacity       - number of agents to allocate room for up front
+        """
+        self.bounds = bounds
+        self.grid_size = grid_size
+        self.valid_headings = list(valid_headings)
+        self.valid_actions = list(valid_actions)
+        self.heading_vectors = np.array(self.valid_headings, dtype=np.int64)
+        self.heading_codes = dict((heading, i) for i, heading in enumerate(self.valid_headings))
+        self.action_codes = dict((action, i) for i, action in enumerate(self.valid_actions))
+
+        self.agents = []     # agent id -> agent
+        self.ids = dict()    # agent -> agent id
+        self.n = 0           # number of agents stored
+
+        self.location = np.zeros((capacity, 2), dtype=np.int64)
+        self.heading = np.zeros(capacity, dtype=np.int8)
+        self.destination = np.zeros((capacity, 2), dtype=np.int64)
+        self.has_destination = np.zeros(capacity, dtype=bool)
+        self.deadline = np.zeros(capacity, dtype=np.int64)
+        self.has_deadline = np.zeros(capacity, dtype=bool)
+        self.waypoint = np.zeros(capacity, dtype=np.int8)
+        self.batched = np.zeros(capacity, dtype=bool)  # moved by the batched dummy update
+
+
+    def _grow(self):
+        """
+        Double the capacity of every array.
+        """
+
+        for name in ('location', 'heading', 'destination', 'has_destination',
+                     'deadline', 'has_deadline', 'waypoint', 'batched'):
+            old = getattr(self, name)
+            new = np.zeros((2 * len(old),) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+
+    def add(self, agent, location, heading, batched=False):
+        """
+        Register a new agent and return its id.
+        """
+
+        if self.n == len(self.heading):
+            self._grow()
+
+        i = self.n
+        self.agents.append(agent)
+        self.ids[agent] = i
+        self.n += 1
+
+        self.location[i] = location
+        self.heading[i] = self.heading_codes[heading]
+        self.has_destination[i] = False
+        self.has_deadline[i] = False
+        self.waypoint[i] = self.action_codes[agent.next_waypoint]
+        self.batched[i] = batched
+        return i
+
+
+    def add_many(self, n, batched=True):
+        """
+        Register n agents with no agent object at once (e.g. the dummies of a
+        vecenv.VecEnvironment) and return their ids. Their states are set
+        straight in the arrays, and they have no view.
+        """
+
+        while self.n + n > len(self.heading):
+            self._grow()
+
+        ids = np.arange(self.n, self.n + n)
+        self.agents.extend([None] * n)
+        self.n += n
+
+        self.has_destination[ids] = False
+        self.has_deadline[ids] = False
+        self.batched[ids] = batched
+        return ids
+
+
+    def view(self, agent):
+        """
+        Return a dict-like view onto the state of an agent.
+        """
+
+        return AgentStateView(self, self.ids[agent])
+
+
+    def cells(self, ids=None):
+        """
+        Return the intersection index of the given agents (all agents by default).
+        Intersections are numbered in the order of Environment.intersections.
+        """
+
+        location = self.location[:self.n] if ids is None else self.location[ids]
+        return (location[:, 0] - self.bounds[0]) * self.grid_size[1] + (location[:, 1] - self.bounds[1])
+
+
+    def agents_at(self, location):
+        """
+        Return the agents standing at the given intersection.
+        """
+
+        ids = np.flatnonzero((self.location[:self.n, 0] == location[0]) & (self.location[:self.n, 1] == location[1]))
+        return [self.agents[i] for i in ids]
+
+
+    def get_waypoint(self, agent):
+        """
+        Return the next waypoint stored for an agent.
+        """
+
+        return self.valid_actions[self.waypoint[self.ids[agent]]]
+
+
+    def unbatched(self):
+        """
+        Return the agents that are updated one at a time (e.g. the primary agent).
+        """
+
+        return [self.agents[i] for i in np.flatnonzero(~self.batched[:self.n])]
+
+
+    def scatter(self, exclude=()):
+        """
+        Place every agent except those in 'exclude' on a distinct random
+        (intersection, heading) slot and clear their destinations and deadlines.
+        """
+
+        ids = np.arange(self.n)
+        if exclude:
+            ids = np.setdiff1d(ids, [self.ids[agent] for agent in exclude])
+
+        n_headings = len(self.valid_headings)
+        slots = np.random.choice(self.grid_size[0] * self.grid_size[1] * n_headings, len(ids), replace=False)
+        self.place(ids, slots)
+        self.has_destination[ids] = False
+        self.has_deadline[ids] = False
+
+
+    def place(self, ids, slots):
+        """
+        Put the given agents on the given (intersection, heading) slots,
+        numbered intersection * number of headings + heading code.
+        """
+
+        n_headings = len(self.valid_headings)
+        cells = slots // n_headings
+        self.location[ids, 0] = cells // self.grid_size[1] + self.bounds[0]
+        self.location[ids, 1] = cells % self.grid_size[1] + self.bounds[1]
+        self.heading[ids] = slots % n_headings
+
+
+    def move(self, ids, headings):
+        """
+        Turn the given agents to the given heading codes and move them one
+        intersection forward, wrapping around the edges of the world.
+        """
+
+        steps = self.heading_vectors[headings]
+        lo = np.array(self.bounds[:2])
+        size = np.array(self.grid_size)
+        self.location[ids] = (self.location[ids] + steps - lo) % size + lo
+        self.heading[ids] = headings
+
+
+class AgentStateView(object):
+    """
+    View onto one agent's entry in an AgentStateArrays store, with the same
+    fields as environment.AgentState. Reads and writes go straight through
+    to the arrays.
+    """
+
+    __slots__ = ('store', 'i')
+    fields = ('location', 'heading', 'destination', 'deadline')
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+
+    @property
+    def location(self):
+        return (int(self.store.location[self.i, 0]), int(self.store.location[self.i, 1]))
+
+    @location.setter
+    def location(self, value):
+        self.store.location[self.i] = value
+
+    @property
+    def heading(self):
+        return self.store.valid_headings[self.store.heading[self.i]]
+
+    @heading.setter
+    def heading(self, value):
+        self.store.heading[self.i] = self.store.heading_codes[value]
+
+    @property
+    def destination(self):
+        if not self.store.has_destination[self.i]:
+            return None
+        return (int(self.store.destination[self.i, 0]), int(self.store.destination[self.i, 1]))
+
+    @destination.setter
+    def destination(self, value):
+        self.store.has_destination[self.i] = value is not None
+        if value is not None:
+            self.store.destination[self.i] = value
+
+    @property
+    def deadline(self):
+        return int(self.store.deadline[self.i]) if self.store.has_deadline[self.i] else None
+
+    @deadline.setter
+    def deadline(self, value):
+        self.store.has_deadline[self.i] = value is not None
+        if value is not None:
+            self.store.deadline[self.i] = value
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields else default
+
+    def keys(self):
+        return list(self.fields)
+
+    def __repr__(self):
+        return repr(dict((key, getattr(self, key)) for key in self.fields))
+
+
+class AgentStatesView(object):
+    """
+    Compatibility view that makes an AgentStateArrays store look like the
+    agent -> state dict (Environment.agent_states) of the dict backend.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, agent):
+        return agent in self.store.ids
+
+    def __len__(self):
+        return self.store.n
+
+    def __iter__(self):
+        return iter(self.store.agents)
+
+    def __getitem__(self, agent):
+        return self.store.view(agent)
+
+    def __setitem__(self, agent, state):
+        view = self.store.view(agent)
+        for key in AgentStateView.fields:
+            view[key] = state.get(key)
+
+    def keys(self):
+        return list(self.store.agents)
+
+    def iterkeys(self):
+        return iter(self.store.agents)
+
+    def itervalues(self):
+        for agent in self.store.agents:
+            yield self.store.view(agent)
+
+    def iteritems(self):
+        for agent in self.store.agents:
+            yield agent, self.store.view(agent)
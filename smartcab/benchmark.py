@@ -0,0 +1,164 @@
+
+"""
+Benchmarks for the environment and agent hot paths.
+Times Environment.step, sense, act and reset, RoutePlanner.next_waypoint
+and LearningAgent.update over a sweep of world sizes, and writes the
+results to logs/ as JSON and CSV.
+"""
+
+import os
+import random
+import json
+import csv
+from timeit import default_timer as clock
+
+from environment import Environment
+from agent import LearningAgent
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def percentile(values, q):
+    """
+    Return the q-th percentile (0-100) of a list of values, nearest rank.
+    """
+
+    values = sorted(values)
+    index = int(round(q / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(timings):
+    """
+    Turn a list of per-call durations (in seconds) into summary statistics.
+    Latencies are reported in microseconds.
+    """
+
+    total = sum(timings)
+    return {
+        'calls':         len(timings),
+        'calls_per_sec': len(timings) / total if total > 0 else 0.0,
+        'mean_us':       total / len(timings) * 1e6,
+        'p50_us':        percentile(timings, 50) * 1e6,
+        'p90_us':        percentile(timings, 90) * 1e6,
+        'p99_us':        percentile(timings, 99) * 1e6,
+        'max_us':        max(timings) * 1e6,
+    }
+
+
+def bench_world(num_dummies, grid_size, use_arrays=False, n_steps=1000, n_calls=1000, seed=0):
+    """
+    Time the hot paths in one world.
+    Returns a dictionary of timings (lists of seconds per call) by name.
+    """
+
+    random.seed(seed)
+    if np is not None:
+        np.random.seed(seed)  # the array backend draws from numpy.random
+    env = Environment(num_dummies=num_dummies, grid_size=grid_size, use_arrays=use_arrays)
+    agent = env.create_agent(LearningAgent, learning=True)
+    env.set_primary_agent(agent, enforce_deadline=True)
+    agent.n_trials = n_steps  # keep epsilon high so the agent keeps exploring
+    env.reset()
+
+    timings = dict((name, []) for name in ('step', 'reset', 'sense', 'act', 'next_waypoint', 'update'))
+    others = [a for a in env.agent_states if a is not agent]
+
+    # Environment.reset
+    for i in xrange(n_calls):
+        start = clock()
+        env.reset()
+        timings['reset'].append(clock() - start)
+
+    # Environment.step, a full tick including every agent update
+    for i in xrange(n_steps):
+        if env.done:
+            env.reset()
+        start = clock()
+        env.step()
+        timings['step'].append(clock() - start)
+
+    # Environment.sense, with the per-tick cache cleared so every call does the work
+    for i in xrange(n_calls):
+        other = random.choice(others)
+        env.sense_cache.clear()
+        start = clock()
+        env.sense(other)
+        timings['sense'].append(clock() - start)
+
+    # Environment.act, for dummies taking a random action
+    for i in xrange(n_calls):
+        other = random.choice(others)
+        action = random.choice(env.valid_actions)
+        start = clock()
+        env.act(other, action)
+        timings['act'].append(clock() - start)
+
+    # RoutePlanner.next_waypoint and LearningAgent.update, for the primary agent
+    env.reset()
+    for i in xrange(n_calls):
+        if env.done:
+            env.reset()
+        start = clock()
+        agent.planner.next_waypoint()
+        timings['next_waypoint'].append(clock() - start)
+
+        start = clock()
+        agent.update()
+        timings['update'].append(clock() - start)
+        env.advance()
+
+    return timings
+
+
+def run(dummies=(10, 100, 1000), grid_sizes=((8, 6), (16, 12), (32, 24)), use_arrays=False,
+        n_steps=500, n_calls=1000, filename="benchmark"):
+    """
+    Run the benchmark sweep.
+    Every combination of 'dummies' and 'grid_sizes' that fits on the grid is
+    timed, and the results are written to logs/<filename>.json and .csv.
+    Returns the result rows.
+    """
+
+    rows = []
+    for grid_size in grid_sizes:
+        for num_dummies in dummies:
+            # Dummies each need their own (intersection, heading) slot
+            if num_dummies + 1 > grid_size[0] * grid_size[1] * len(Environment.valid_headings):
+                continue
+
+            timings = bench_world(num_dummies, grid_size, use_arrays, n_steps, n_calls)
+            for name in sorted(timings):
+                row = {
+                    'call':        name,
+                    'num_dummies': num_dummies,
+                    'grid_size':   "{}x{}".format(*grid_size),
+                    'use_arrays':  use_arrays,
+                }
+                row.update(summarize(timings[name]))
+                rows.append(row)
+
+            step = summarize(timings['step'])
+            print "{:>8} dummies on {:>7}: {:9.1f} steps/sec  (p50 {:8.1f} us, p99 {:8.1f} us)".format(
+                num_dummies, "{}x{}".format(*grid_size), step['calls_per_sec'], step['p50_us'], step['p99_us'])
+
+    # Write the results
+    if not os.path.exists("logs"):
+        os.makedirs("logs")
+    with open(os.path.join("logs", filename + ".json"), 'wb') as f:
+        json.dump(rows, f, indent=2, sort_keys=True)
+    fields = ['call', 'num_dummies', 'grid_size', 'use_arrays', 'calls', 'calls_per_sec',
+              'mean_us', 'p50_us', 'p90_us', 'p99_us', 'max_us']
+    with open(os.path.join("logs", filename + ".csv"), 'wb') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return rows
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,105 @@
+
+"""
+Convergence monitor.
+Watches a learning agent's Q-table from trial to trial, so training can end
+as soon as the policy has settled instead of when epsilon runs out.
+"""
+
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # the monitor compares Q-tables as arrays, so it needs NumPy
+
+
+class ConvergenceMonitor(object):
+    """
+    Tracks, over a window of recent training trials, how far the agent's
+    greedy policy moved and how large its learning updates were, so training
+    can stop while alpha is still above 0.
+    A greedy action counts as changed only if, after the trial, it is worse
+    than the best action of its state by more than 'margin', so swaps between
+    actions of nearly equal value, which the noisy rewards cause all along,
+    are ignored. Updates are measured as the mean |change| of the Q-values
+    that moved, divided by alpha, which takes out the learning rate and
+    leaves the size of the errors the agent is still learning from.
+    Training has converged once, over a full window, no greedy action
+    changed, the mean update was at most 'delta', and the rate of trials
+    reaching the destination in time was at least 'reliability'.
+    """
+
+    def __init__(self, window=20, margin=1.0, delta=2.0, reliability=0.0):
+        """
+        window      - discrete number of recent training trials to judge
+        margin      - value by which a greedy action must fall behind the best
+                      action of its state to count as changed (the random part
+                      of the reward alone spans [-1, 1])
+        delta       - largest mean Q-value update, per unit of alpha, allowed
+                      over the window
+        reliability - smallest rate of trials reaching the destination in time;
+                      training trials explore, so this is off by default
+        """
+        if np is None:
+            raise ImportError("ConvergenceMonitor.__init__(): Unable to import numpy")
+        self.window = window
+        self.margin = margin
+        self.delta = delta
+        self.reliability = reliability
+
+        self.updates = deque(maxlen=window)  # mean Q-value update per unit of alpha, by trial
+        self.changes = deque(maxlen=window)  # greedy actions changed, by trial
+        self.successes = deque(maxlen=window)
+        self.before = None  # Q-values at the start of the current trial
+        self.converged = False
+
+
+    def start_trial(self, agent):
+        """
+        Take a snapshot of the agent's Q-values as a training trial begins.
+        """
+
+        self.before = agent.Q.to_array()
+
+
+    def end_trial(self, agent, success):
+        """
+        Compare the agent's Q-values with the snapshot once the trial is over,
+        record the trial and return whether training has converged.
+        """
+
+        after = agent.Q.to_array()
+
+        # Newly visited pairs count as moving from 0, as they do in learn
+        old = np.nan_to_num(self.before)
+        new = np.nan_to_num(after)
+        moved = old != new
+        if moved.any() and agent.alpha > 0:
+            self.updates.append(float(np.abs(new - old)[moved].mean()) / agent.alpha)
+        else:
+            self.updates.append(0.0)
+
+        # Greedy actions of the states visited so far that have fallen behind
+        seen = ~np.isnan(after).all(axis=1)
+        old, new = old[seen], new[seen]
+        greedy = new[np.arange(len(new)), old.argmax(axis=1)]
+        self.changes.append(int((new.max(axis=1) - greedy > self.margin).sum()))
+
+        self.successes.append(success)
+        self.converged = len(self.successes) == self.window and \
+                         sum(self.changes) == 0 and \
+                         sum(self.updates) / self.window <= self.delta and \
+                         float(sum(self.successes)) / self.window >= self.reliability
+        return self.converged
+
+
+    def summary(self):
+        """
+        Return a one-line summary of the current window.
+        """
+
+        if not self.successes:
+            return "no trials yet"
+        return "mean update {:.2f}  greedy changes {}  reliability {:.2f}".format(
+            sum(self.updates) / len(self.updates), sum(self.changes),
+            float(sum(self.successes)) / len(self.successes))
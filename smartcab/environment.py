@@ -8,30 +8,73 @@ import time
 import random
 import math
 from collections import OrderedDict
+from timeit import default_timer as clock
 
 from simulator import Simulator
 
+try:
+    import numpy as np
+    from arraystate import AgentStateArrays, AgentStatesView
+except ImportError:
+    np = None  # the array backend is unavailable without NumPy
+
 
 class TrafficLight(object):
     """
     A traffic light that switches periodically.
+    Its schedule lives in the environment's light arrays; this is a view
+    onto one entry, so reading the state costs O(1) at any time step.
     """
 
     #. use symbols/strings
     valid_states = [True, False]  # True = NS open; False = EW open
+    valid_periods = [2, 3, 4, 5] #.magic
+
+    def __init__(self, env, index):
+        self.env = env
+        self.index = index  # position in the environment's light arrays
+
+    @property
+    def state(self):
+        return self.env.light_state(self.index)
+
+    @property
+    def period(self):
+        return self.env.light_period[self.index]
+
+
+class AgentState(object):
+    """
+    The location, heading, destination and deadline of one agent.
+    Fields can also be read and written by name, as with a dict.
+    """
+
+    __slots__ = ('location', 'heading', 'destination', 'deadline')
+
+    def __init__(self, location, heading, destination=None, deadline=None):
+        self.location = location
+        self.heading = heading
+        self.destination = destination
+        self.deadline = deadline
 
-    def __init__(self, state=None, period=None):
-        self.state = state if state is not None else random.choice(self.valid_states)
-        self.period = period if period is not None else random.choice([2, 3, 4, 5]) #.magic
-        self.last_updated = 0
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
 
-    def reset(self):
-        self.last_updated = 0
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
 
-    def update(self, t):
-        if t - self.last_updated >= self.period:
-            self.state = not self.state  # Assuming state is boolean
-            self.last_updated = t
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def __repr__(self):
+        return repr(dict((key, getattr(self, key)) for key in self.__slots__))
 
 
 class Environment(object):
@@ -40,6 +83,7 @@ class Environment(object):
     """
 
     hard_time_limit = -100  # Set a hard time limit even if deadline is not enforced.
+    min_distance = 4        # Minimum L1 distance from start to destination
     #. define these here?
     # num_dummies     = 100 # number of other agents on the roads
     # grid_size       = (8, 6) # columns, rows
@@ -55,12 +99,13 @@ class Environment(object):
 
 
     #. put verbose last
-    def __init__(self, verbose=False, num_dummies=100, grid_size = (8, 6)): #. magic #s
+    def __init__(self, verbose=False, num_dummies=100, grid_size = (8, 6), use_arrays=False): #. magic #s
         """
         Create an environment
         verbose     - set to True to display additional output from the simulation
         num_dummies - discrete number of dummy agents in the environment
         grid_size   - discrete number of intersections (columns, rows)
+        use_arrays  - set to True to keep agent states in NumPy arrays and move dummies in batches
         """
 
         self.num_dummies = num_dummies  # Number of dummy driver agents in the environment
@@ -70,6 +115,9 @@ class Environment(object):
         self.done = False
         self.t = 0 #? integer time step
         self.agent_states = OrderedDict()
+        self.occupancy = dict() # agents standing at each intersection, kept in sync with agent_states
+        self.sense_cache = dict() # sensor readings taken this time step, by intersection and agent
+        self.waypoints = dict()   # (dx, dy, heading) -> waypoint, filled in by the route planners
         self.step_data = {}
         self.success = None #? did the agent reach the destination in time?
 
@@ -79,30 +127,44 @@ class Environment(object):
         self.block_size = 100  #?
         self.hang = 0.6  #?
         self.intersections = OrderedDict() #?
-        self.roads = []  #?
+        self._roads = None  # built on first use, see roads
+
+        # Traffic light schedules, indexed in the order of self.intersections
+        # A light flips every 'period' steps, so its state at any time step
+        # follows from its state at the start of the trial
+        self.light_initial = []  # state at the start of the current trial
+        self.light_period = []   # time steps between flips
+        self.light_arrays = None # NumPy copies of the above, built on demand
 
         #? Add traffic lights to each intersection
         for x in xrange(self.bounds[0], self.bounds[2] + 1):
             for y in xrange(self.bounds[1], self.bounds[3] + 1):
-                self.intersections[(x, y)] = TrafficLight()  # A traffic light at each intersection
-
-        #? Add roads between adjacent traffic lights
-        for a in self.intersections:
-            for b in self.intersections:
-                if a == b:
-                    continue
-                if (abs(a[0] - b[0]) + abs(a[1] - b[1])) == 1:  # L1 distance = 1
-                    self.roads.append((a, b))
-
-        # Add environment boundaries
-        #? what is this? roads along edges?
-        #. prefer range over xrange for upwards compatibility
-        for x in range(self.bounds[0], self.bounds[2] + 1):
-            self.roads.append(((x, self.bounds[1] - self.hang), (x, self.bounds[1])))
-            self.roads.append(((x, self.bounds[3] + self.hang), (x, self.bounds[3])))
-        for y in range(self.bounds[1], self.bounds[3] + 1):
-            self.roads.append(((self.bounds[0] - self.hang, y), (self.bounds[0], y)))
-            self.roads.append(((self.bounds[2] + self.hang, y), (self.bounds[2], y)))
+                self.intersections[(x, y)] = TrafficLight(self, len(self.light_period))  # A traffic light at each intersection
+                self.light_initial.append(random.choice(TrafficLight.valid_states))
+                self.light_period.append(random.choice(TrafficLight.valid_periods))
+                self.occupancy[(x, y)] = list()
+        self.locations = self.intersections.keys() # intersections as a list, for sampling
+
+        # Toroidal distance along each axis, by absolute coordinate difference
+        self.dist_x = [min(d, self.grid_size[0] - d) for d in xrange(self.grid_size[0])]
+        self.dist_y = [min(d, self.grid_size[1] - d) for d in xrange(self.grid_size[1])]
+        self._distances = None  # all-pairs distance matrix, built on demand, see distance_matrix
+
+        # Offsets from a start to every destination that is far enough away
+        self.trip_offsets = [(dx, dy) for dx in xrange(self.grid_size[0]) for dy in xrange(self.grid_size[1])
+                             if self.compute_dist((0, 0), (dx, dy)) >= self.min_distance]
+
+        # Array-backed agent states, if requested
+        # agent_states then becomes a view onto the arrays, and the occupancy
+        # index is replaced by array lookups
+        self.arrays = None
+        if use_arrays:
+            if np is not None:
+                self.arrays = AgentStateArrays(self.bounds, self.grid_size, self.valid_headings, self.valid_actions)
+                self.agent_states = AgentStatesView(self.arrays)
+                self.occupancy = None
+            else:
+                print "Environment.__init__(): Unable to import numpy; array backend disabled."
 
         # Create dummy agents
         for i in range(self.num_dummies):
@@ -112,6 +174,15 @@ class Environment(object):
         self.primary_agent = None  # to be set explicitly
         self.enforce_deadline = False
 
+        # Fleet mode: more learning smartcabs alongside the primary agent, see add_cab
+        self.fleet = []            # cabs other than the primary agent
+        self.cabs = []             # primary agent first, then the fleet
+        self.cab_data = OrderedDict() # cab -> its trial data (the primary agent's is trial_data)
+        self.finished = set()      # cabs that have reached their destination or run out of time
+
+        # Optional phase profiler, see set_profiler
+        self.profiler = None
+
         # Trial data (updated at the end of each trial)
         self.trial_data = {
             'testing': False,        # if the trial is for testing a learned policy
@@ -125,6 +196,39 @@ class Environment(object):
         }
 
 
+    @property
+    def roads(self):
+        """
+        Road segments between adjacent intersections, plus the stubs along the edges.
+        Only the renderer needs them, so they are built on first use.
+        """
+
+        if self._roads is None:
+            roads = []
+
+            #? Add roads between adjacent traffic lights
+            # Each intersection connects to its neighbours in the four headings,
+            # which gives every adjacent pair in both directions
+            for a in self.intersections:
+                for heading in self.valid_headings:
+                    b = (a[0] + heading[0], a[1] + heading[1])
+                    if b in self.intersections:
+                        roads.append((a, b))
+
+            # Add environment boundaries
+            #? what is this? roads along edges?
+            #. prefer range over xrange for upwards compatibility
+            for x in range(self.bounds[0], self.bounds[2] + 1):
+                roads.append(((x, self.bounds[1] - self.hang), (x, self.bounds[1])))
+                roads.append(((x, self.bounds[3] + self.hang), (x, self.bounds[3])))
+            for y in range(self.bounds[1], self.bounds[3] + 1):
+                roads.append(((self.bounds[0] - self.hang, y), (self.bounds[0], y)))
+                roads.append(((self.bounds[2] + self.hang, y), (self.bounds[2], y)))
+
+            self._roads = roads
+        return self._roads
+
+
     def create_agent(self, agent_class, *args, **kwargs):
         """
         Create an agent in the environment at a random location.
@@ -137,8 +241,13 @@ class Environment(object):
         agent = agent_class(self, *args, **kwargs)
         # ? what is heading? why a tuple?
         # self.agent_states[agent] = {'location': random.choice(self.intersections.keys()), 'heading': (0, 1)}
-        intersection = random.choice(self.intersections.keys())
-        self.agent_states[agent] = {'location': intersection, 'heading': (0, 1)}
+        intersection = random.choice(self.locations)
+        if self.arrays is not None:
+            # Plain dummies are moved by the batched update, everything else one at a time
+            self.arrays.add(agent, intersection, (0, 1), batched=(type(agent) is DummyAgent))
+        else:
+            self.agent_states[agent] = AgentState(intersection, (0, 1))
+            self.occupancy[intersection].append(agent)
         return agent
 
 
@@ -147,107 +256,145 @@ class Environment(object):
         Set the given agent as the primary agent.
         The primary agent is the smartcab that is followed in the environment.
         """
+        if self.primary_agent is not None:
+            self.primary_agent.primary_agent = False
         self.primary_agent = agent
         agent.primary_agent = True
         self.enforce_deadline = enforce_deadline
+        self.cabs = [agent] + self.fleet
 
 
-    def reset(self, testing=False):
+    def add_cab(self, agent):
         """
-        Begin a new trial.
+        Add a learning smartcab that drives alongside the primary agent, with
+        its own start, destination, deadline and trial data (see cab_data).
+        Cabs are treated like the primary agent: other agents' sensors ignore
+        them and their deadline follows the primary agent's enforce_deadline.
+        A trial ends once every cab has reached its destination or run out of time.
         """
+        agent.primary_agent = True
+        self.fleet.append(agent)
+        self.cabs = ([self.primary_agent] if self.primary_agent is not None else []) + self.fleet
 
-        self.done = False
-        self.t = 0
 
-        # Reset status text
-        self.step_data = {} #? this is status text?
+    def random_trip(self):
+        """
+        Pick a random start, heading, destination and deadline for a trip,
+        with the destination not too close to the start.
+        """
 
-        # Reset traffic lights
-        for traffic_light in self.intersections.itervalues():
-            traffic_light.reset()
-
-        # Pick a random start and destination
-        start = random.choice(self.intersections.keys())
-        destination = random.choice(self.intersections.keys())
-
-        # Ensure starting location and destination are not too close
-        while self.compute_dist(start, destination) < 4: #. magic number
-            start = random.choice(self.intersections.keys())
-            destination = random.choice(self.intersections.keys())
-
-        # # Pick a random start and destination that aren't too close
-        # min_distance = 4
-        # distance = 0
-        # while distance < min_distance:
-        #     start = random.choice(self.intersections.keys())
-        #     destination = random.choice(self.intersections.keys())
-        #     distance = self.compute_dist(start, destination)
+        # Distances on the torus only depend on the offset between two points,
+        # so a uniform start plus a uniform valid offset is a uniform valid trip
+        start = random.choice(self.locations)
+        offset = random.choice(self.trip_offsets)
+        destination = ((start[0] + offset[0] - self.bounds[0]) % self.grid_size[0] + self.bounds[0],
+                       (start[1] + offset[1] - self.bounds[1]) % self.grid_size[1] + self.bounds[1])  # wrap-around
 
         start_heading = random.choice(self.valid_headings) #. pick a direction
-        distance = self.compute_dist(start, destination) #. would already have from above
+        distance = self.compute_dist(start, destination)
         deadline = distance * 5 # 5 time steps per intersection away #. magic number
 
         if self.verbose: # Debugging
             print "Environment.reset(): Trial set up with start = {}, destination = {}, deadline = {}".format(start, destination, deadline)
 
-        # Create a map of all possible initial positions
-        #? what is this?
-        positions = dict()
-        for location in self.intersections:
-            positions[location] = list()
-            for heading in self.valid_headings:
-                positions[location].append(heading)
+        return start, start_heading, destination, deadline
+
+
+    def set_profiler(self, profiler):
+        """
+        Record time spent in each phase of a time step with the given
+        profiler.PhaseProfiler: the primary agent update, the other agent
+        updates, sense, act and the reward computation.
+        """
+
+        self.profiler = profiler
+        profiler.wrap(self, 'sense', 'sense')
+        profiler.wrap(self, 'act', 'act')
+        profiler.wrap(self, 'compute_reward', 'reward')
+
+
+    def reset(self, testing=False):
+        """
+        Begin a new trial.
+        """
+
+        # Reset traffic lights
+        # Lights keep their current state, but their schedules restart at t = 0
+        if self.t > 0:
+            self.light_initial = list(self.light_states())
+            self.light_arrays = None
+
+        self.done = False
+        self.t = 0
+
+        # Reset status text
+        self.step_data = {} #? this is status text?
+        self.sense_cache.clear()
+
+        # Pick a random trip (start, heading, destination, deadline) for the
+        # primary agent and every other cab
+        trips = dict((cab, self.random_trip()) for cab in self.cabs)
+        cab_data = dict()
+        self.finished.clear()
+
+        if self.arrays is not None:
+            # Place every other agent in one go; only the agents that are not
+            # batched need the per-agent loop below
+            self.arrays.scatter(exclude=self.cabs)
+            agents = self.arrays.unbatched()
+        else:
+            # Agents are about to be placed again, so start from empty intersections
+            for agents in self.occupancy.itervalues():
+                del agents[:]
+            agents = self.agent_states.iterkeys()
+
+            # Every other agent gets its own (intersection, heading) slot,
+            # drawn all at once as a random sample of the slot numbers
+            n_others = len(self.agent_states) - len([cab for cab in self.cabs if cab in self.agent_states])
+            slots = iter(random.sample(xrange(len(self.locations) * len(self.valid_headings)), n_others))
 
         # Initialize agent(s)
         #? why is the set of agents called agent_states and not just agents?
         #. call it agent_key also
-        for agent in self.agent_states.iterkeys():
+        for agent in agents:
             #. agent = self.agents[agent_key]
             # or
             # for agent in self.agents.values():
 
-            if agent is self.primary_agent:
+            trip = trips.get(agent)
+            if trip is not None:
             # if agent.primary_agent: #. better?
                 #. wait, the environment is storing the agents states? why?
-                self.agent_states[agent] = {
-                    'location': start,
-                    'heading': start_heading,
-                    'destination': destination,
-                    'deadline': deadline
-                }
-
-            # For dummy agents, make them choose one of the available
-            # intersections and headings still in 'positions'
-            else:
-                intersection = random.choice(positions.keys())
-                heading = random.choice(positions[intersection])
-                self.agent_states[agent] = {
-                    'location': intersection,
-                    'heading': heading,
-                    'destination': None,
-                    'deadline': None
-                }
-                # Now delete the taken location and heading from 'positions'
-                positions[intersection] = list(set(positions[intersection]) - set([heading]))
-                if positions[intersection] == list(): # No headings available for intersection
-                    del positions[intersection] # Delete the intersection altogether
+                self.agent_states[agent] = AgentState(*trip)
 
+            # For dummy agents, place them on the next free slot
+            elif self.arrays is None:
+                slot = next(slots)
+                self.agent_states[agent] = AgentState(self.locations[slot // len(self.valid_headings)],
+                                                      self.valid_headings[slot % len(self.valid_headings)])
+
+
+            if self.arrays is None:
+                self.occupancy[self.agent_states[agent].location].append(agent)
 
             #? whoa, so agent is an object, and it's used as the key in self.agent_states -
             # weird...
-            agent.reset(destination=(destination if agent is self.primary_agent else None), testing=testing)
+            agent.reset(destination=(trip[2] if trip is not None else None), testing=testing)
 
-            if agent is self.primary_agent:
+            if trip is not None:
                 # Reset metrics for this trial (step data will be set during the step)
-                self.trial_data['testing'] = testing
-                self.trial_data['initial_deadline'] = deadline
-                self.trial_data['final_deadline'] = deadline
-                self.trial_data['net_reward'] = 0.0
-                self.trial_data['actions'] = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0}
-                self.trial_data['parameters'] = {'e': agent.epsilon, 'a': agent.alpha}
-                self.trial_data['success'] = 0
-                self.trial_data['coverage'] = 0
+                data = self.trial_data if agent is self.primary_agent else dict()
+                data['testing'] = testing
+                data['initial_deadline'] = trip[3]
+                data['final_deadline'] = trip[3]
+                data['net_reward'] = 0.0
+                data['actions'] = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0}
+                data['parameters'] = {'e': agent.epsilon, 'a': agent.alpha}
+                data['success'] = 0
+                data['coverage'] = 0
+                cab_data[agent] = data
+
+        self.cab_data = OrderedDict((cab, cab_data[cab]) for cab in self.cabs)
 
 
     def step(self):
@@ -266,37 +413,101 @@ class Environment(object):
             print "Environment.step(): t = {}".format(self.t)
 
         # Update agents, primary first
-        if self.primary_agent is not None:
-            self.primary_agent.update()
-        for agent in self.agent_states.iterkeys():
-            if agent is not self.primary_agent:
-                agent.update()
+        if self.primary_agent is not None and self.primary_agent not in self.finished:
+            if self.profiler is not None:
+                start = clock()
+                self.primary_agent.update()
+                self.profiler.add('primary_update', clock() - start)
+            else:
+                self.primary_agent.update()
+        self.advance()
 
-        # Update traffic lights
-        for intersection, traffic_light in self.intersections.iteritems():
-            traffic_light.update(self.t)
 
-        #? update primary agent's deadline #. rename to time_remaining
-        if self.primary_agent is not None:
+    def advance(self):
+        """
+        Finish a time step once the primary agent has acted: update the other
+        agents, count down the deadline of every cab still on the road, and
+        advance the time (which is all the traffic lights need).
+        Called by step, or directly when the primary agent is driven from outside.
+        """
+
+        # Update the other agents
+        if self.profiler is not None:
+            start = clock()
+        if self.arrays is not None:
+            for agent in self.arrays.unbatched():
+                if not agent.primary_agent:
+                    agent.update()
+            self.update_cabs()
+            self.update_batched()
+            self.sense_cache.clear() # nearly every intersection has changed
+        else:
+            for agent in self.agent_states.iterkeys():
+                if not agent.primary_agent:
+                    agent.update()
+            self.update_cabs()
+        if self.profiler is not None:
+            self.profiler.add('dummy_updates', clock() - start)
+
+        # Traffic lights need no update: their state follows from self.t
+
+        #? update each cab's deadline #. rename to time_remaining
+        for cab in self.cabs:
         #. if self.primary_agent:
+            if cab in self.finished:
+                continue
+
             # Agent has taken an action: reduce the deadline by 1
-            agent_deadline = self.agent_states[self.primary_agent]['deadline'] - 1
-            self.agent_states[self.primary_agent]['deadline'] = agent_deadline
+            state = self.agent_states[cab]
+            state.deadline -= 1
+            agent_deadline = state.deadline
             #. Agent has taken an action: reduce the time remaining by 1
             #. self.agent_states[self.primary_agent]['time_remaining'] -= 1
 
             if agent_deadline <= self.hard_time_limit:
-                self.done = True
-                self.success = False
+                self.finish(cab, False)
                 if self.verbose: # Debugging
-                    print "Environment.step(): Primary agent hit hard time limit ({})! Trial aborted.".format(self.hard_time_limit)
+                    print "Environment.advance(): {} hit hard time limit ({})! Trial aborted.".format(self.cab_name(cab), self.hard_time_limit)
             elif self.enforce_deadline and agent_deadline <= 0:
-                self.done = True
-                self.success = False
+                self.finish(cab, False)
                 if self.verbose: # Debugging
-                    print "Environment.step(): Primary agent ran out of time! Trial aborted."
+                    print "Environment.advance(): {} ran out of time! Trial aborted.".format(self.cab_name(cab))
 
         self.t += 1 # environment stores the global time state
+        self.sense_cache.clear() # the lights may have changed
+
+
+    def update_cabs(self):
+        """
+        Update the cabs of the fleet that are still on their trip.
+        """
+
+        for cab in self.fleet:
+            if cab not in self.finished:
+                cab.update()
+
+
+    def cab_name(self, cab):
+        """
+        Name a cab in messages: the primary agent, or its number in the fleet.
+        """
+
+        if cab is self.primary_agent:
+            return "Primary agent"
+        return "Cab {}".format(self.cabs.index(cab))
+
+
+    def finish(self, cab, success):
+        """
+        Take a cab off the road for the rest of the trial, which ends once
+        every cab has finished.
+        """
+
+        self.finished.add(cab)
+        if cab is self.primary_agent:
+            self.success = success
+        if len(self.finished) == len(self.cabs):
+            self.done = True
 
 
     def sense(self, agent): #. rename - getSensorInformation?
@@ -308,42 +519,82 @@ class Environment(object):
 
         #? Get location, heading, light status for given agent
         state = self.agent_states[agent]  #. should just get state directly from agent, not environment
-        location = state['location']
-        heading = state['heading']
+        location = state.location
+
+        # Readings stay valid for the rest of the time step unless an agent
+        # enters or leaves this intersection
+        cached = self.sense_cache.get(location)
+        if cached is not None and agent in cached:
+            return cached[agent]
+
+        heading = state.heading
         #. confusing... - use red/green instead of heading 0/1
-        light = 'green' if (self.intersections[location].state and heading[1] != 0) or \
-                ((not self.intersections[location].state) and heading[0] != 0) else 'red'
+        light_state = self.light_state(self.intersections[location].index)
+        light = 'green' if (light_state and heading[1] != 0) or \
+                ((not light_state) and heading[0] != 0) else 'red'
 
         # Populate oncoming, left, right
         #? which are...?
         oncoming = None
         left = None
         right = None
-        for other_agent, other_state in self.agent_states.iteritems():
+        # Only the agents standing at this intersection can show up on the sensors
+        others = self.occupancy[location] if self.arrays is None else self.arrays.agents_at(location)
+        for other_agent in others:
+            other_state = self.agent_states[other_agent]
             #. confusing
-            if agent == other_agent or location != other_state['location'] or \
-               (heading[0] == other_state['heading'][0] and heading[1] == other_state['heading'][1]):
+            if agent == other_agent or location != other_state.location or \
+               (heading[0] == other_state.heading[0] and heading[1] == other_state.heading[1]):
                 continue
-            # For dummy agents, ignore the primary agent
+            # For dummy agents, ignore the primary agent (and any other cab)
             # This is because the primary agent is not required to follow the waypoint
-            if other_agent == self.primary_agent: #. should use 'is' ?
+            if other_agent.primary_agent:
                 continue
             other_heading = other_agent.get_next_waypoint()
             # ?
             #. confusing
-            if (heading[0] * other_state['heading'][0] + heading[1] * other_state['heading'][1]) == -1:
+            if (heading[0] * other_state.heading[0] + heading[1] * other_state.heading[1]) == -1:
                 if oncoming != 'left':  # we don't want to override oncoming == 'left'
                     oncoming = other_heading
-            elif (heading[1] == other_state['heading'][0] and -heading[0] == other_state['heading'][1]):
+            elif (heading[1] == other_state.heading[0] and -heading[0] == other_state.heading[1]):
                 if right != 'forward' and right != 'left':  # we don't want to override right == 'forward or 'left'
                     right = other_heading
             else:
                 if left != 'forward':  # we don't want to override left == 'forward'
                     left = other_heading
 
-        #. sensors = {light: light, ...}
-        # return sensors
-        return {'light': light, 'oncoming': oncoming, 'left': left, 'right': right}
+        sensors = {'light': light, 'oncoming': oncoming, 'left': left, 'right': right}
+        self.sense_cache.setdefault(location, dict())[agent] = sensors
+        return sensors
+
+
+    def light_state(self, i):
+        """
+        Returns the state of the i-th traffic light at the current time step.
+        """
+
+        # The schedule flips a light at t = period, 2 * period, ... after the
+        # agents have moved, so agents at time t see the flips up to t - 1
+        t = self.t
+        flipped = t > 0 and ((t - 1) // self.light_period[i]) % 2 == 1
+        return self.light_initial[i] != flipped
+
+
+    def light_states(self):
+        """
+        Returns the state of every traffic light at the current time step,
+        in the order of self.intersections.
+        """
+
+        if np is None:
+            return [self.light_state(i) for i in xrange(len(self.light_period))]
+
+        if self.light_arrays is None:
+            self.light_arrays = (np.array(self.light_initial, dtype=bool), np.array(self.light_period))
+        initial, period = self.light_arrays
+        if self.t == 0:
+            return initial.copy()
+        return initial != (((self.t - 1) // period) % 2 == 1)
 
 
     #. bad name - should be time remaining
@@ -352,7 +603,7 @@ class Environment(object):
         Returns the deadline remaining for an agent.
         """
 
-        return self.agent_states[agent]['deadline'] if agent is self.primary_agent else None
+        return self.agent_states[agent].deadline if agent.primary_agent else None
 
 
     def act(self, agent, action):
@@ -370,11 +621,12 @@ class Environment(object):
         assert (action in self.valid_actions), "Invalid action!"
 
         state = self.agent_states[agent]
-        location = state['location']
-        heading = state['heading']
+        location = state.location
+        heading = state.heading
         #. confusing, duplicate code
-        light = 'green' if (self.intersections[location].state and heading[1] != 0) or \
-                ((not self.intersections[location].state) and heading[0] != 0) else 'red'
+        light_state = self.light_state(self.intersections[location].index)
+        light = 'green' if (light_state and heading[1] != 0) or \
+                ((not light_state) and heading[0] != 0) else 'red'
         inputs = self.sense(agent)
 
         # Assess whether the agent can move based on the action chosen.
@@ -387,25 +639,6 @@ class Environment(object):
         # 4: Major traffic violation causing an accident
         violation = 0
 
-        # Reward scheme
-        # First initialize reward uniformly random from [-1, 1]
-        reward = 2 * random.random() - 1
-
-        # Create a penalty factor as a function of remaining deadline
-        # Scales reward multiplicatively from [0, 1]
-        #? fnc means what?
-        fnc = self.t * 1.0 / (self.t + state['deadline']) if agent.primary_agent else 0.0
-        gradient = 10 #. magic number - gradient of what?
-
-        # No penalty given to an agent that has no enforced deadline
-        #. put this in an else clause below
-        penalty = 0
-
-        # If the deadline is enforced, give a penalty based on time remaining
-        #? explain penalty fn
-        if self.enforce_deadline:
-            penalty = (math.pow(gradient, fnc) - 1) / (gradient - 1)
-
         # Agent wants to drive forward:
         if action == 'forward':
             if light != 'green': # Running red light
@@ -440,88 +673,235 @@ class Environment(object):
                 violation = 1 # Minor violation
 
 
+        # Score the action before the agent moves, as the waypoint depends on its location
+        reward = self.compute_reward(agent, state, action, violation, light)
+
         # Did the agent attempt a valid move?
         if violation == 0:
-            #. magic numbers
-            if action == agent.get_next_waypoint(): # Was it the correct action?
-                reward += 2 - penalty # (2, 1)
-            elif action == None and light != 'green': # Was the agent stuck at a red light?
-                reward += 2 - penalty # (2, 1)
-            else: # Valid but incorrect
-                reward += 1 - penalty # (1, 0)
-
             # Move the agent
             if action is not None:
                 #. confusing - wrap around torus world?
                 location = ((location[0] + heading[0] - self.bounds[0]) % (self.bounds[2] - self.bounds[0] + 1) + self.bounds[0],
                             (location[1] + heading[1] - self.bounds[1]) % (self.bounds[3] - self.bounds[1] + 1) + self.bounds[1])  # wrap-around
-                state['location'] = location
-                state['heading'] = heading
-        # Agent attempted invalid move
-        else:
-            #. magic #s - keys and rewards - define as a dictionary at start
-            if violation == 1: # Minor violation
-                reward += -5
-            elif violation == 2: # Major violation
-                reward += -10
-            elif violation == 3: # Minor accident
-                reward += -20
-            elif violation == 4: # Major accident
-                reward += -40
+                if self.arrays is None:
+                    self.occupancy[state.location].remove(agent)
+                    self.occupancy[location].append(agent)
+                self.sense_cache.pop(state.location, None)
+                self.sense_cache.pop(location, None)
+                state.location = location
+                state.heading = heading
 
         # Did agent reach the goal after a valid move?
-        if agent is self.primary_agent:
-            if state['location'] == state['destination']:
+        if agent.primary_agent:
+            data = self.cab_data[agent]
+            if state.location == state.destination:
                 # Did agent get to destination before deadline?
-                if state['deadline'] >= 0:
-                    self.trial_data['success'] = 1
+                if state.deadline >= 0:
+                    data['success'] = 1
 
-                # Stop the trial
-                self.done = True
-                self.success = True
+                # Stop the trial (once every cab is done)
+                self.finish(agent, True)
 
                 if self.verbose: # Debugging
-                    print "Environment.act(): Primary agent has reached destination!"
+                    print "Environment.act(): {} has reached destination!".format(self.cab_name(agent))
 
             if self.verbose: # Debugging
                 print "Environment.act() [POST]: location: {}, heading: {}, action: {}, reward: {}".format(location, heading, action, reward)
 
+            data['final_deadline'] = state.deadline - 1
+            data['net_reward'] += reward
+            data['actions'][violation] += 1
+            data['coverage'] = agent.coverage
+
+        if agent is self.primary_agent:
             # Update metrics
             self.step_data['t'] = self.t
             self.step_data['violation'] = violation
             self.step_data['state'] = agent.get_state()
-            self.step_data['deadline'] = state['deadline']
+            self.step_data['deadline'] = state.deadline
             self.step_data['waypoint'] = agent.get_next_waypoint()
             self.step_data['inputs'] = inputs
             self.step_data['light'] = light
             self.step_data['action'] = action
             self.step_data['reward'] = reward
 
-            self.trial_data['final_deadline'] = state['deadline'] - 1
-            self.trial_data['net_reward'] += reward
-            self.trial_data['actions'][violation] += 1
-            self.trial_data['coverage'] = agent.coverage
-
             if self.verbose: # Debugging
                 print "Environment.act(): Step data: {}".format(self.step_data)
 
         return reward
 
 
+    def compute_reward(self, agent, state, action, violation, light):
+        """
+        Returns the reward for an agent's action, given the violation it
+        caused (0 if none) and the light it faced.
+        """
+
+        # Reward scheme
+        # First initialize reward uniformly random from [-1, 1]
+        reward = 2 * random.random() - 1
+
+        # Create a penalty factor as a function of remaining deadline
+        # Scales reward multiplicatively from [0, 1]
+        #? fnc means what?
+        fnc = self.t * 1.0 / (self.t + state.deadline) if agent.primary_agent else 0.0
+        gradient = 10 #. magic number - gradient of what?
+
+        # No penalty given to an agent that has no enforced deadline
+        #. put this in an else clause below
+        penalty = 0
+
+        # If the deadline is enforced, give a penalty based on time remaining
+        #? explain penalty fn
+        if self.enforce_deadline:
+            penalty = (math.pow(gradient, fnc) - 1) / (gradient - 1)
+
+        # Did the agent attempt a valid move?
+        if violation == 0:
+            #. magic numbers
+            if action == agent.get_next_waypoint(): # Was it the correct action?
+                reward += 2 - penalty # (2, 1)
+            elif action == None and light != 'green': # Was the agent stuck at a red light?
+                reward += 2 - penalty # (2, 1)
+            else: # Valid but incorrect
+                reward += 1 - penalty # (1, 0)
+        # Agent attempted invalid move
+        else:
+            #. magic #s - keys and rewards - define as a dictionary at start
+            if violation == 1: # Minor violation
+                reward += -5
+            elif violation == 2: # Major violation
+                reward += -10
+            elif violation == 3: # Minor accident
+                reward += -20
+            elif violation == 4: # Major accident
+                reward += -40
+
+        return reward
+
+
+    def update_batched(self):
+        """
+        Update all batched dummy agents at once using array operations.
+        Follows the same traffic rules as DummyAgent.update, but every dummy
+        senses the intersection as it was before any of them moved, and they
+        then all move together.
+        """
+
+        store = self.arrays
+        n = store.n
+        codes = store.action_codes
+        n_headings = len(self.valid_headings)
+
+        # Agents updated one at a time may have picked new waypoints
+        # (their get_next_waypoint never reads the arrays)
+        for agent in store.unbatched():
+            store.waypoint[store.ids[agent]] = codes[agent.get_next_waypoint()]
+
+        # The primary agent and other cabs are ignored, as in sense
+        others = np.ones(n, dtype=bool)
+        for cab in self.cabs:
+            others[store.ids[cab]] = False
+        cells = store.cells()
+        headings = store.heading[:n].astype(np.int64)
+        waypoints = store.waypoint[:n]
+        green = self.light_states()[cells] == (headings % 2 == 1)
+        okay = self.safe_moves(cells, headings, waypoints, green, others, len(self.intersections))
+
+        # Move to the next waypoints and choose new ones
+        turns = np.zeros(len(self.valid_actions), dtype=np.int64)
+        turns[codes['left']] = 1
+        turns[codes['right']] = 3
+        moving = np.flatnonzero(store.batched[:n] & okay)
+        store.move(moving, (headings[moving] + turns[waypoints[moving]]) % n_headings)
+        store.waypoint[moving] = np.random.randint(1, len(self.valid_actions), len(moving)) #. assumes first is None
+
+
+    @staticmethod
+    def safe_moves(cells, headings, waypoints, green, visible, n_cells):
+        """
+        Return which agents can safely follow their waypoints under the
+        DummyAgent traffic rules, for all of them at once.
+        cells, headings and waypoints hold each agent's intersection index,
+        heading code and waypoint code, green whether it faces a green light,
+        and visible whether other agents see it as traffic. Every agent
+        senses its intersection as it is, before any of them moves.
+        """
+
+        forward, left, right = [Environment.valid_actions.index(action) for action in ('forward', 'left', 'right')]
+        n_headings = len(Environment.valid_headings)
+
+        # Which (intersection, heading) approaches hold a car about to go forward,
+        # turn left, or go forward or right
+        approaches = cells * n_headings + headings
+        n_approaches = n_cells * n_headings
+        going_forward = np.bincount(approaches[visible & (waypoints == forward)], minlength=n_approaches) > 0
+        turning_left = np.bincount(approaches[visible & (waypoints == left)], minlength=n_approaches) > 0
+        forward_or_right = np.bincount(approaches[visible & ((waypoints == forward) | (waypoints == right))], minlength=n_approaches) > 0
+
+        # Headings are E, N, W, S: odd codes travel north-south, and relative to
+        # a heading h the oncoming car has h + 2 and the car on the left h + 3
+        left_forward = going_forward[cells * n_headings + (headings + 3) % n_headings]
+        oncoming = cells * n_headings + (headings + 2) % n_headings
+        oncoming_conflict = ~turning_left[oncoming] & forward_or_right[oncoming]
+
+        # Check if the chosen waypoints are safe to move to
+        return np.where(waypoints == right, green | ~left_forward,
+               np.where(waypoints == forward, green, green & ~oncoming_conflict))
+
+
     def compute_dist(self, a, b):
         """
         Compute the Manhattan (L1) distance of a toroidal world.
+        Both points must be on the grid.
         """
 
-        dx1 = abs(b[0] - a[0])
-        dx2 = abs(self.grid_size[0] - dx1)
-        dx = dx1 if dx1 < dx2 else dx2
+        return self.dist_x[abs(b[0] - a[0])] + self.dist_y[abs(b[1] - a[1])]
 
-        dy1 = abs(b[1] - a[1])
-        dy2 = abs(self.grid_size[1] - dy1)
-        dy = dy1 if dy1 < dy2 else dy2
 
-        return dx + dy
+    def compute_dists(self, a, b):
+        """
+        Compute the toroidal L1 distances between two arrays of points,
+        each of shape (n, 2), in one go. Returns an array of n distances.
+        """
+
+        if np is None:
+            return [self.compute_dist(p, q) for p, q in zip(a, b)]
+
+        d = np.abs(np.asarray(b) - np.asarray(a))
+        size = np.array(self.grid_size)
+        return np.minimum(d, size - d).sum(axis=-1)
+
+
+    def distance_matrix(self):
+        """
+        Return the matrix of distances between every pair of intersections,
+        in the order of self.locations. Built on first use; it has one entry
+        per pair, so only ask for it on grids of moderate size.
+        """
+
+        if self._distances is None:
+            if np is None:
+                self._distances = [[self.compute_dist(p, q) for q in self.locations] for p in self.locations]
+            else:
+                points = np.array(self.locations)
+                self._distances = self.compute_dists(points[:, None, :], points[None, :, :])
+        return self._distances
+
+
+    def random_trips(self, n):
+        """
+        Draw n random trips the way reset does, for bulk analysis.
+        Returns arrays of starts (n, 2), destinations (n, 2) and distances (n,).
+        Requires NumPy.
+        """
+
+        lo = np.array(self.bounds[:2])
+        size = np.array(self.grid_size)
+        starts = np.array(self.locations)[np.random.randint(len(self.locations), size=n)]
+        offsets = np.array(self.trip_offsets)[np.random.randint(len(self.trip_offsets), size=n)]
+        destinations = (starts + offsets - lo) % size + lo
+        return starts, destinations, self.compute_dists(starts, destinations)
 
 
 class Agent(object):
@@ -529,6 +909,9 @@ class Agent(object):
     Base class for all agents
     """
 
+    # Subclasses that add attributes without declaring slots get a __dict__ as usual
+    __slots__ = ('env', 'state', 'next_waypoint', 'color', 'primary_agent', '_sprite', '_sprite_size')
+
     def __init__(self, env):
         self.env = env
         self.state = None
@@ -554,6 +937,7 @@ class DummyAgent(Agent):
     An agent that operates randomly in the environment.
     """
 
+    __slots__ = ()
     color_choices = ['cyan', 'red', 'blue', 'green', 'orange', 'magenta', 'yellow']
 
     def __init__(self, env):
@@ -563,6 +947,15 @@ class DummyAgent(Agent):
         self.color = random.choice(self.color_choices)
 
 
+    def get_next_waypoint(self):
+        # Dummies moved by the batched update keep their waypoint in the
+        # environment's arrays; any other dummy (e.g. a subclass) keeps its own
+        store = self.env.arrays
+        if store is not None and store.batched[store.ids[self]]:
+            return store.get_waypoint(self)
+        return self.next_waypoint
+
+
     def update(self):
         """
         Update a DummyAgent to move randomly under legal traffic laws.
@@ -16,6 +16,7 @@ class RoutePlanner(object):
         self.env = env
         self.agent = agent
         self.destination = None
+        self.table = env.waypoints  # shared by every planner in the environment
 
 
     def route_to(self, destination=None):
@@ -24,23 +25,40 @@ class RoutePlanner(object):
         """
 
         #. can't do destination or other?
-        self.destination = destination if destination is not None else random.choice(self.env.intersections.keys())
+        self.destination = destination if destination is not None else random.choice(self.env.locations)
 
 
     def next_waypoint(self):
         """
         Create the next waypoint based on current heading, location,
         intended destination and L1 distance from destination.
+        The answer is looked up in the environment's waypoint table, which maps
+        (destination x - location x, destination y - location y, heading) to
+        the waypoint and is filled in as each key is first seen. The raw
+        difference is used rather than the wrapped one, as it decides which
+        way around the world ties are broken.
         """
 
-        # Collect global location details
-        bounds = self.env.grid_size
         #. again, bad to ask environment for agent state
-        location = self.env.agent_states[self.agent]['location']
-        heading = self.env.agent_states[self.agent]['heading']
+        state = self.env.agent_states[self.agent]
+        location = state.location
+        key = (self.destination[0] - location[0], self.destination[1] - location[1], state.heading)
+        try:
+            return self.table[key]
+        except KeyError:
+            waypoint = self.table[key] = self.compute_waypoint(key[:2], key[2], self.env.grid_size)
+            return waypoint
+
+
+    @staticmethod
+    def compute_waypoint(delta_a, heading, bounds):
+        """
+        Work out the waypoint for a destination delta_a away from the current
+        location (not wrapped around the world), given the current heading
+        and the grid size.
+        """
 
         #? what are these?
-        delta_a = (self.destination[0] - location[0], self.destination[1] - location[1])
         delta_b = (bounds[0] + delta_a[0] if delta_a[0] <= 0 else delta_a[0] - bounds[0], \
                    bounds[1] + delta_a[1] if delta_a[1] <= 0 else delta_a[1] - bounds[1])
 
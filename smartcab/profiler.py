@@ -0,0 +1,91 @@
+
+"""
+Phase profiler.
+Records cumulative time and call counts for the phases of a time step and
+of a trial, per trial and per run.
+"""
+
+from timeit import default_timer as clock
+
+
+class PhaseProfiler(object):
+    """
+    Cumulative wall-clock time and call counts, by phase name.
+    Phases may nest (e.g. 'sense' runs inside 'dummy_updates'), in which case
+    the inner time is counted in both.
+    """
+
+    def __init__(self):
+        self.trial = dict()  # phase -> [seconds, calls] for the current trial
+        self.total = dict()  # phase -> [seconds, calls] for the whole run
+        self.n_trials = 0
+
+
+    def add(self, phase, seconds):
+        """
+        Record one call of a phase that took 'seconds'.
+        """
+
+        record = self.trial.get(phase)
+        if record is None:
+            record = self.trial[phase] = [0.0, 0]
+        record[0] += seconds
+        record[1] += 1
+
+
+    def wrap(self, obj, name, phase):
+        """
+        Time every call of method 'name' on 'obj' as 'phase'.
+        The timed version is installed on the instance, so objects that are
+        not profiled pay nothing.
+        """
+
+        method = getattr(obj, name)
+        add = self.add
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                add(phase, clock() - start)
+
+        setattr(obj, name, timed)
+
+
+    def end_trial(self):
+        """
+        Close the current trial: fold its phases into the run totals and
+        return them.
+        """
+
+        trial = self.trial
+        for phase, (seconds, calls) in trial.iteritems():
+            record = self.total.setdefault(phase, [0.0, 0])
+            record[0] += seconds
+            record[1] += calls
+        self.trial = dict()
+        self.n_trials += 1
+        return trial
+
+
+    def summary(self, phases):
+        """
+        Return a one-line summary of phases as 'name ms/calls' pairs.
+        """
+
+        return "  ".join("{} {:.1f}ms/{}".format(phase, phases[phase][0] * 1000, phases[phase][1])
+                         for phase in sorted(phases))
+
+
+    def report(self):
+        """
+        Return a table of the run totals, slowest phase first.
+        """
+
+        header_format = "{:16}  {:>10}  {:>10}  {:>12}"
+        row_format =    "{:16}  {:10.3f}  {:10d}  {:12.2f}"
+        lines = [header_format.format("Phase", "Total (s)", "Calls", "Per call (us)"), "-" * 54]
+        for phase, (seconds, calls) in sorted(self.total.iteritems(), key=lambda item: -item[1][0]):
+            lines.append(row_format.format(phase, seconds, calls, seconds / calls * 1e6 if calls else 0.0))
+        return "\n".join(lines)
@@ -0,0 +1,386 @@
+
+"""
+Q-tables for the learning agent.
+QTable is the original dictionary of state -> {action: value} dictionaries.
+DenseQTable keeps the same values in an n_states x n_actions NumPy array,
+with states encoded as integer row indices.
+Unvisited state-action pairs have a value of None in both, and both count
+their visited pairs in n_visited as values are set.
+Both also cache, per state, the tuple of unvisited actions and the tuple of
+actions tied for the highest value, recomputed only when a value of that
+state changes, so choosing an action needs no list building.
+Either table can be saved to and loaded from a .npy file of Q-values, with
+NaN for unvisited pairs, see save_table and load_table.
+"""
+
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # the dense table is unavailable without NumPy
+
+
+class StateEncoder(object):
+    """
+    Maps state tuples to integer indices and back, by mixed radix over the
+    domain of each state feature.
+    """
+
+    def __init__(self, states, domains):
+        """
+        states  - tuple of state feature names, e.g. ('light', 'waypoint')
+        domains - dictionary of the possible values of each feature, by name
+        """
+        self.states = tuple(states)
+        self.domains = [list(domains[name]) for name in self.states]
+        self.codes = [dict((value, i) for i, value in enumerate(domain)) for domain in self.domains]
+        self.n = 1
+        for domain in self.domains:
+            self.n *= len(domain)
+        self.index = dict()  # state -> index, filled in as states are seen
+
+
+    def encode(self, state):
+        """
+        Return the index of a state tuple.
+        """
+
+        i = self.index.get(state)
+        if i is None:
+            i = 0
+            for codes, value in zip(self.codes, state):
+                i = i * len(codes) + codes[value]
+            self.index[state] = i
+        return i
+
+
+    def decode(self, i):
+        """
+        Return the state tuple of an index.
+        """
+
+        values = []
+        for domain in reversed(self.domains):
+            i, code = divmod(i, len(domain))
+            values.append(domain[code])
+        return tuple(reversed(values))
+
+
+    def all_states(self):
+        """
+        Return every state tuple, in index order.
+        """
+
+        return list(itertools.product(*self.domains))
+
+
+class QTable(dict):
+    """
+    Dictionary-backed Q-table: state -> {action: value}.
+    """
+
+    def __init__(self, actions, encoder=None):
+        """
+        actions - the valid actions
+        encoder - StateEncoder for the agent's state tuples, needed to save and load the table
+        """
+        super(QTable, self).__init__()
+        self.actions = list(actions)
+        self.encoder = encoder
+        self.n_visited = 0  # number of state-action pairs with a value
+        self.unvisited = dict() # state -> tuple of unvisited actions
+        self.greedy = dict()    # state -> tuple of actions tied for the max value
+
+
+    def create_state(self, state):
+        """
+        Add a state with every action unvisited, if it is not there yet.
+        """
+
+        if not state in self:
+            self[state] = dict((action, None) for action in self.actions)
+            self.refresh(state)
+
+
+    def get_value(self, state, action):
+        """
+        Return the value of a state-action pair, or None if unvisited.
+        """
+
+        return self[state][action]
+
+
+    def set_value(self, state, action, value):
+        """
+        Set the value of a state-action pair.
+        """
+
+        data = self[state]
+        if data[action] is None:
+            self.n_visited += 1
+        data[action] = value
+        self.refresh(state)
+
+
+    def refresh(self, state):
+        """
+        Recompute the cached unvisited and greedy actions of a state.
+        Unvisited actions count as 0 when looking for the greedy ones.
+        """
+
+        data = self[state]
+        maxQ = max(data.values()) or 0
+        self.unvisited[state] = tuple(action for action in data if data[action] is None)
+        self.greedy[state] = tuple(action for action in data if (data[action] or 0) == maxQ)
+
+
+    def max_value(self, state):
+        """
+        Return the maximum value over the actions of a state, None if no
+        action has been visited.
+        """
+
+        return max(self[state].values())
+
+
+    def unvisited_actions(self, state):
+        """
+        Return the actions of a state that have no value yet.
+        """
+
+        return self.unvisited[state]
+
+
+    def to_array(self):
+        """
+        Return the Q-values as an n_states x n_actions array, NaN where unvisited.
+        """
+
+        values = np.empty((self.encoder.n, len(self.actions)))
+        values.fill(np.nan)
+        for state, data in self.iteritems():
+            i = self.encoder.encode(state)
+            for j, action in enumerate(self.actions):
+                if data[action] is not None:
+                    values[i, j] = data[action]
+        return values
+
+
+    def from_array(self, values):
+        """
+        Replace the contents of the table with an array from to_array.
+        """
+
+        self.clear()
+        self.unvisited.clear()
+        self.greedy.clear()
+        self.n_visited = 0
+        visited = ~np.isnan(values)
+        for i in np.flatnonzero(visited.any(axis=1)):
+            state = self.encoder.decode(i)
+            self.create_state(state)
+            for j in np.flatnonzero(visited[i]):
+                self.set_value(state, self.actions[j], float(values[i, j]))
+
+
+    def greedy_actions(self, state):
+        """
+        Return the actions tied for the highest value in a state, counting
+        unvisited actions as 0.
+        """
+
+        return self.greedy[state]
+
+
+class DenseQTable(object):
+    """
+    Array-backed Q-table.
+    Values live in an n_states x n_actions array, and a boolean mask of the
+    same shape marks the visited state-action pairs.
+    Indexing by state (table[state]) returns an {action: value} dictionary,
+    so the table reads like a QTable.
+    """
+
+    def __init__(self, encoder, actions):
+        """
+        encoder - StateEncoder for the agent's state tuples
+        actions - the valid actions, in column order
+        """
+        self.encoder = encoder
+        self.actions = list(actions)
+        self.action_codes = dict((action, i) for i, action in enumerate(self.actions))
+        self.values = np.zeros((encoder.n, len(self.actions)))
+        self.visited = np.zeros((encoder.n, len(self.actions)), dtype=bool)
+        self.created = np.zeros(encoder.n, dtype=bool)  # states the agent has been in
+        self.n_visited = 0  # number of state-action pairs with a value
+        self.unvisited = [tuple(self.actions)] * encoder.n # index -> tuple of unvisited actions
+        self.greedy = [tuple(self.actions)] * encoder.n    # index -> tuple of actions tied for the max value
+
+
+    def create_state(self, state):
+        """
+        Mark a state as seen. Every state already has a row, so this is only
+        used to list the states of the table.
+        """
+
+        self.created[self.encoder.encode(state)] = True
+
+
+    def get_value(self, state, action):
+        """
+        Return the value of a state-action pair, or None if unvisited.
+        """
+
+        i = self.encoder.encode(state)
+        j = self.action_codes[action]
+        return float(self.values[i, j]) if self.visited[i, j] else None
+
+
+    def set_value(self, state, action, value):
+        """
+        Set the value of a state-action pair.
+        """
+
+        i = self.encoder.encode(state)
+        j = self.action_codes[action]
+        if not self.visited[i, j]:
+            self.visited[i, j] = True
+            self.n_visited += 1
+        self.values[i, j] = value
+        self.refresh(i)
+
+
+    def batch_update(self, states, actions, rewards, alpha):
+        """
+        Apply the learning rule Q <- (1 - alpha) Q + alpha reward to a batch
+        of transitions given as arrays of state indices, action indices and
+        rewards. Transitions that share a state-action pair are averaged, as
+        they all start from the same old value.
+        """
+
+        current = self.values[states, actions] # 0 where unvisited
+        errors = np.zeros(self.values.shape)
+        counts = np.zeros(self.values.shape)
+        np.add.at(errors, (states, actions), rewards - current)
+        np.add.at(counts, (states, actions), 1)
+
+        touched = counts > 0
+        self.values[touched] += alpha * errors[touched] / counts[touched]
+        self.n_visited += int((touched & ~self.visited).sum())
+        self.visited |= touched
+        self.created[states] = True
+        for i in np.unique(states):
+            self.refresh(i)
+
+
+    def refresh(self, i):
+        """
+        Recompute the cached unvisited and greedy actions of state index i.
+        Unvisited actions count as 0 when looking for the greedy ones.
+        """
+
+        values = self.values[i].tolist()
+        visited = self.visited[i].tolist()
+        seen = [value for value, v in zip(values, visited) if v]
+        maxQ = max(seen) if seen else 0.0
+        self.unvisited[i] = tuple(action for action, v in zip(self.actions, visited) if not v)
+        self.greedy[i] = tuple(action for action, value, v in zip(self.actions, values, visited)
+                               if (value if v else 0.0) == maxQ)
+
+
+    def max_value(self, state):
+        """
+        Return the maximum value over the actions of a state, None if no
+        action has been visited.
+        """
+
+        i = self.encoder.encode(state)
+        visited = self.visited[i]
+        return float(self.values[i][visited].max()) if visited.any() else None
+
+
+    def unvisited_actions(self, state):
+        """
+        Return the actions of a state that have no value yet.
+        """
+
+        return self.unvisited[self.encoder.encode(state)]
+
+
+    def to_array(self):
+        """
+        Return the Q-values as an n_states x n_actions array, NaN where unvisited.
+        """
+
+        return np.where(self.visited, self.values, np.nan)
+
+
+    def from_array(self, values):
+        """
+        Replace the contents of the table with an array from to_array.
+        """
+
+        self.visited = ~np.isnan(values)
+        self.values = np.where(self.visited, values, 0.0)
+        self.created = self.visited.any(axis=1)
+        self.n_visited = int(self.visited.sum())
+        self.unvisited = [tuple(self.actions)] * self.encoder.n
+        self.greedy = [tuple(self.actions)] * self.encoder.n
+        for i in np.flatnonzero(self.created):
+            self.refresh(i)
+
+
+    def greedy_actions(self, state):
+        """
+        Return the actions tied for the highest value in a state, counting
+        unvisited actions as 0.
+        """
+
+        return self.greedy[self.encoder.encode(state)]
+
+
+    def __contains__(self, state):
+        return bool(self.created[self.encoder.encode(state)])
+
+    def __len__(self):
+        return int(self.created.sum())
+
+    def __iter__(self):
+        for i in np.flatnonzero(self.created):
+            yield self.encoder.decode(i)
+
+    def __getitem__(self, state):
+        i = self.encoder.encode(state)
+        return dict((action, float(self.values[i, j]) if self.visited[i, j] else None)
+                    for j, action in enumerate(self.actions))
+
+
+def save_table(table, filename):
+    """
+    Save a Q-table to a .npy file: a float array of n_states x n_actions
+    Q-values, rows in state index order and columns in action order, NaN
+    where unvisited. It can be opened with numpy.load(filename, mmap_mode='r').
+    Raises ImportError if NumPy is not available.
+    """
+
+    if np is None:
+        raise ImportError("save_table(): Unable to import numpy; cannot save {}".format(filename))
+    np.save(filename, table.to_array())
+
+
+def load_table(table, filename):
+    """
+    Replace the contents of a Q-table with the values saved in a .npy file.
+    Raises ValueError if the file was saved for a different state space,
+    and ImportError if NumPy is not available.
+    """
+
+    if np is None:
+        raise ImportError("load_table(): Unable to import numpy; cannot load {}".format(filename))
+    values = np.load(filename, mmap_mode='r')
+    shape = (table.encoder.n, len(table.actions))
+    if values.shape != shape:
+        raise ValueError("Q-table in {} has shape {}, expected {} for states {}".format(
+            filename, values.shape, shape, table.encoder.states))
+    table.from_array(values)
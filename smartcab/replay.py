@@ -0,0 +1,54 @@
+
+"""
+Experience replay for the learning agent.
+A fixed-size ring buffer of (state index, action index, reward) transitions,
+kept in preallocated NumPy arrays.
+"""
+
+import numpy as np
+
+
+class ReplayBuffer(object):
+    """
+    Ring buffer of the last 'capacity' transitions.
+    Once full, each new transition overwrites the oldest one.
+    """
+
+    def __init__(self, capacity):
+        """
+        capacity - discrete number of transitions to keep
+        """
+        self.capacity = capacity
+        self.states = np.zeros(capacity, dtype=np.int64)
+        self.actions = np.zeros(capacity, dtype=np.int8)
+        self.rewards = np.zeros(capacity)
+        self.n = 0     # number of transitions stored
+        self.next = 0  # slot the next transition goes in
+
+
+    def __len__(self):
+        return self.n
+
+
+    def add(self, state, action, reward):
+        """
+        Store one transition, by state and action index.
+        """
+
+        i = self.next
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next = (i + 1) % self.capacity
+        if self.n < self.capacity:
+            self.n += 1
+
+
+    def sample(self, size):
+        """
+        Return 'size' transitions drawn uniformly with replacement, as arrays
+        of states, actions and rewards.
+        """
+
+        ids = np.random.randint(self.n, size=size)
+        return self.states[ids], self.actions[ids], self.rewards[ids]
@@ -12,9 +12,11 @@ import os
 import time
 import random
 import importlib
-import csv
 
 import colory
+import qtable
+from profiler import PhaseProfiler
+from triallog import TrialLogWriter, AsyncLogWriter
 
 
 
@@ -42,9 +44,25 @@ class Simulator(object):
     }
 
 
-    def __init__(self, env, size=None, update_delay=2.0, display=True, log_metrics=False, optimized=False):
+    def __init__(self, env, size=None, update_delay=2.0, display=True, log_metrics=False, optimized=False, headless=False, profile=False,
+                 log_binary=False, print_limit=None, log_async=False):
         """
         Initialize the simulation.
+        env          - the Environment to simulate
+        size         - (width, height) of the GUI window in pixels, by default fitted to the grid
+        update_delay - continuous time (in seconds) between actions
+        display      - set to False to disable the GUI if PyGame is enabled
+        log_metrics  - set to True to log trial and simulation results to /logs
+        optimized    - set to True to change the default log file name
+        headless     - set to True to step the environment back to back, without
+                       the GUI, update delay or text rendering, and report steps/sec
+        profile      - set to True to report time spent in each phase of a time
+                       step and of a trial, per trial and for the whole run
+        log_binary   - set to True to also write the trial log as NumPy columns
+                       (a .npz file next to the .csv), see triallog
+        print_limit  - number of Q-table rows to print when a run ends (all if
+                       None, none if 0); the whole table is still written to the log
+        log_async    - set to True to write the trial log from a background thread
         """
         self.env = env
         #?
@@ -66,7 +84,16 @@ class Simulator(object):
         self.last_updated = 0.0
         self.update_delay = update_delay  # duration between each step (in seconds)
 
-        self.display = display
+        self.headless = headless
+        self.n_steps = 0  # time steps simulated during run
+        self.results = [] # metrics of each trial in the last run
+
+        self.profiler = None
+        if profile:
+            self.profiler = PhaseProfiler()
+            self.env.set_profiler(self.profiler)
+
+        self.display = display and not headless
         if self.display:
             try:
                 self.pygame = importlib.import_module('pygame')
@@ -100,6 +127,7 @@ class Simulator(object):
         # Setup metrics to report
         self.log_metrics = log_metrics
         self.optimized = optimized
+        self.print_limit = print_limit
 
         if self.log_metrics:
             #. a->agent
@@ -118,19 +146,22 @@ class Simulator(object):
             else:
                 self.log_filename = os.path.join("logs", "sim_no-learning.csv")
 
-            #. this should be expanded so the csv is more human (and excel) readable
-            self.log_fields = ['trial', 'testing', 'parameters', 'initial_deadline', 'final_deadline', 'net_reward', 'actions', 'success']
-            self.log_file = open(self.log_filename, 'wb')
-            self.log_writer = csv.DictWriter(self.log_file, fieldnames=self.log_fields)
-            self.log_writer.writeheader()
+            # One typed column per value, see triallog.fields
+            self.log_writer = TrialLogWriter(self.log_filename, binary=log_binary)
+            if log_async:
+                self.log_writer = AsyncLogWriter(self.log_writer)
 
 
-    def run(self, tolerance=0.05, n_test=0):
+    def run(self, tolerance=0.05, n_test=0, train=True, monitor=None):
         """
         Run a simulation of the environment.
 
         tolerance - the minimum epsilon necessary to switch from training to testing (if enabled)
         n_test    - the number of testing trials to run
+        train     - set to False to skip training and go straight to testing,
+                    e.g. with a Q-table loaded by LearningAgent.load_Q
+        monitor   - optional convergence.ConvergenceMonitor; training then also
+                    ends as soon as the monitor finds the Q-table has converged
         """
 
         self.quit = False
@@ -145,6 +176,9 @@ class Simulator(object):
         total_trials = 1
         testing = False
         trial = 1
+        self.n_steps = 0
+        self.results = [] # one row of metrics per trial
+        run_start = time.time()
 
         # Define table format and print header
         # Note that colored cells need 9 extra characters to account for ANSI codes
@@ -159,11 +193,18 @@ class Simulator(object):
 
             # Flip testing switch
             if not testing:
-                if total_trials > n_trials_min: # Must complete minimum number of training trials
+                if not train:
+                    testing = True
+                    trial = 1
+                elif total_trials > n_trials_min: # Must complete minimum number of training trials
                     if a.learning:
                         if a.epsilon < tolerance: # assume epsilon decays towards 0
                             testing = True
                             trial = 1
+                        elif monitor is not None and monitor.converged:
+                            print "Training converged after {} trials ({})".format(total_trials - 1, monitor.summary())
+                            testing = True
+                            trial = 1
                     else:
                         testing = True
                         trial = 1
@@ -183,11 +224,21 @@ class Simulator(object):
             # print "\-------------------------"
             # print
 
-            self.env.reset(testing)
+            # Snapshot the Q-table before the trial (and any replay at reset)
+            watch = monitor is not None and a.learning and not testing
+            if watch:
+                monitor.start_trial(a)
+
+            if self.profiler is not None:
+                start = time.time()
+                self.env.reset(testing)
+                self.profiler.add('reset', time.time() - start)
+            else:
+                self.env.reset(testing)
             self.current_time = 0.0
             self.last_updated = 0.0
             self.start_time = time.time()
-            while True:
+            while not self.headless:
                 try:
                     # Update current time
                     self.current_time = time.time() - self.start_time
@@ -210,6 +261,7 @@ class Simulator(object):
                     #. and all agents within
                     if self.current_time - self.last_updated >= self.update_delay:
                         self.env.step() #. this updates all agents, eh?
+                        self.n_steps += 1
                         self.last_updated = self.current_time
 
                     # Render text
@@ -226,21 +278,42 @@ class Simulator(object):
                     if self.quit or self.env.done:
                         break
 
+            # Headless: step back to back until the trial is over
+            if self.headless:
+                self.run_trial()
+
             if self.quit:
                 break
 
+            if self.profiler is not None:
+                start = time.time()
+
             # Collect metrics from trial
+            row = {
+                'trial': trial,
+                'testing': self.env.trial_data['testing'],
+                'parameters': self.env.trial_data['parameters'],
+                'initial_deadline': self.env.trial_data['initial_deadline'],
+                'final_deadline': self.env.trial_data['final_deadline'],
+                'net_reward': self.env.trial_data['net_reward'],
+                'actions': self.env.trial_data['actions'],
+                'success': self.env.trial_data['success']
+            }
+            if self.env.fleet: # trial data of every cab, primary agent first
+                row['cabs'] = [dict(data) for data in self.env.cab_data.itervalues()]
+            self.results.append(row)
+            if watch:
+                monitor.end_trial(a, row['success'])
             if self.log_metrics:
-                self.log_writer.writerow({
-                    'trial': trial,
-                    'testing': self.env.trial_data['testing'],
-                    'parameters': self.env.trial_data['parameters'],
-                    'initial_deadline': self.env.trial_data['initial_deadline'],
-                    'final_deadline': self.env.trial_data['final_deadline'],
-                    'net_reward': self.env.trial_data['net_reward'],
-                    'actions': self.env.trial_data['actions'],
-                    'success': self.env.trial_data['success']
-                })
+                if self.env.fleet: # one log row per cab, the primary agent (cab 0) first
+                    for cab, data in enumerate(row['cabs']):
+                        self.log_writer.writerow(dict(data, trial=trial, cab=cab))
+                else:
+                    self.log_writer.writerow(row)
+
+            if self.profiler is not None:
+                self.profiler.add('logging', time.time() - start)
+                start = time.time()
 
             # Trial finished
             # if self.env.success == True:
@@ -266,6 +339,16 @@ class Simulator(object):
 
             # Print table row
             print row_format.format(trial_type, trial, epsilon, avg_reward, violations, accidents, coverage, status)
+            if self.env.fleet:
+                cabs = row['cabs']
+                print "          Fleet: {} of {} cabs on time, {} violations, {} accidents".format(
+                    sum(cab['success'] for cab in cabs), len(cabs),
+                    sum(cab['actions'][1] + cab['actions'][2] for cab in cabs),
+                    sum(cab['actions'][3] + cab['actions'][4] for cab in cabs))
+
+            if self.profiler is not None:
+                self.profiler.add('table_print', time.time() - start)
+                print "          " + self.profiler.summary(self.profiler.end_trial())
 
             # Increment
             total_trials = total_trials + 1
@@ -281,65 +364,109 @@ class Simulator(object):
                 # f.write("| State-action rewards from Q-Learning\n")
                 # f.write("\-----------------------------------------\n\n")
 
-                #. a->agent
-
-                # Define output table format
-                # Cells are all 8 chars wide with 2 chars padding
-                n_state_values   = len(a.states)
-                n_actions        = len(a.valid_actions)
-                first_row_format = "{:^" + str(n_state_values*(8+2)) + "}" + " | " + "{:^" + str(n_actions*(8+2)) + "}"
-                header_format    = "{:8}  " * n_state_values + " | " + "{:>8}  " * n_actions
-                row_format       = header_format
-
-                # Define output table header rows
-                first_row        = first_row_format.format("States", "Actions and Rewards")
-                separator_row    = "-" * ((n_state_values + n_actions)*(8+2)) + "-"
-                header_values    = a.states + tuple(a.valid_actions) # combine state and action names
-                header_row       = header_format.format(*header_values)
-
-                # Iterate over states in the Q table and add to our output table
-                #. rename a.Q to a.Q_table?
-                table = []
-                for state in a.Q:
-                    action_rewards = a.Q[state]
-                    values = []
-                    for state_value in state:
-                        values.append(state_value)
-                    for action in a.valid_actions:
-                        value = action_rewards.get(action, 0) #. 0?
-                        if value:
-                            value = "{:8.2f}".format(value)
-                        else:
-                            value = " " * 8
-                        values.append(value)
-                    row = row_format.format(*values)
-                    table.append(row)
-
-                # Sort the table, add the header rows, and convert to a string
-                table = sorted(table)
-                table = [first_row, header_row, separator_row] + table
-                s = '\n'.join(table)
-
-                # Print the table
-                print
-                print 'Q table:'
-                print
-                print s
-
-                # Write the table to a file
-                f = self.table_file
-                f.write(s)
+                self.write_table(a, self.table_file, self.print_limit)
                 self.table_file.close()
 
-            self.log_file.close()
+                # Save the Q-table in binary form, for warm starts (see LearningAgent.load_Q)
+                if qtable.np is not None:
+                    a.save_Q(os.path.splitext(self.table_filename)[0] + ".npy")
+                else:
+                    print "Simulator.run(): Unable to import numpy; binary Q-table not saved."
+
+            self.log_writer.close()
 
         print "\nSimulation ended..."
 
+        if self.profiler is not None:
+            if self.profiler.trial:
+                self.profiler.end_trial() # trial cut short by a quit
+            print
+            print "Profile ({} trials):".format(self.profiler.n_trials)
+            print self.profiler.report()
+
+        if self.headless:
+            elapsed = time.time() - run_start
+            print "Simulated {} steps in {:.2f} seconds ({:.0f} steps/sec)".format(
+                self.n_steps, elapsed, self.n_steps / elapsed if elapsed > 0 else 0.0)
+
         # Report final metrics
         if self.display:
             self.pygame.display.quit()  # shut down pygame
 
 
+    def run_trial(self):
+        """
+        Step the environment until the current trial is over, with no clock
+        polling or rendering. Used in headless mode.
+        """
+
+        env = self.env
+        n_steps = 0
+        try:
+            while not env.done:
+                env.step()
+                n_steps += 1
+        except KeyboardInterrupt:
+            self.quit = True
+        self.n_steps += n_steps
+
+
+    def write_table(self, a, f, print_limit=None):
+        """
+        Write the Q-table of agent 'a' to file 'f', sorted by state, one row
+        at a time, and print its first 'print_limit' rows (all if None,
+        nothing if 0).
+        """
+
+        #. a->agent
+
+        # Define output table format
+        # Cells are all 8 chars wide with 2 chars padding
+        n_state_values   = len(a.states)
+        n_actions        = len(a.valid_actions)
+        first_row_format = "{:^" + str(n_state_values*(8+2)) + "}" + " | " + "{:^" + str(n_actions*(8+2)) + "}"
+        state_format     = "{:8}  " * n_state_values
+        header_format    = state_format + " | " + "{:>8}  " * n_actions
+
+        # Define output table header rows
+        first_row        = first_row_format.format("States", "Actions and Rewards")
+        separator_row    = "-" * ((n_state_values + n_actions)*(8+2)) + "-"
+        header_values    = a.states + tuple(a.valid_actions) # combine state and action names
+        header_row       = header_format.format(*header_values)
+        header           = '\n'.join([first_row, header_row, separator_row])
+
+        # Sort the states by their formatted cells, which sorts the rows the
+        # same way as sorting the whole formatted rows would
+        states = sorted((state_format.format(*state), state) for state in a.Q)
+
+        if print_limit != 0:
+            print
+            print 'Q table:'
+            print
+            print header
+
+        f.write(header)
+        for n, (cells, state) in enumerate(states):
+            action_rewards = a.Q[state]
+            values = []
+            for action in a.valid_actions:
+                value = action_rewards.get(action, 0) #. 0?
+                if value:
+                    value = "{:8.2f}".format(value)
+                else:
+                    value = " " * 8
+                values.append(value)
+            row = cells + " | " + "{:>8}  " * n_actions
+            row = row.format(*values)
+            f.write('\n')
+            f.write(row)
+            if print_limit is None or n < print_limit:
+                print row
+
+        if print_limit and len(states) > print_limit:
+            print "... {} more rows in {}".format(len(states) - print_limit, getattr(f, 'name', 'the table file'))
+
+
     def render_text(self, trial, testing=False):
         """
         This is the non-GUI render display of the simulation.
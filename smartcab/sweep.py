@@ -0,0 +1,205 @@
+
+"""
+Hyperparameter sweeps.
+Runs many smartcab configurations across a process pool and collects the
+safety and reliability rating of each run into one results table.
+"""
+
+import os
+import sys
+import csv
+import time
+import random
+import itertools
+import multiprocessing
+
+from environment import Environment
+from agent import LearningAgent
+from simulator import Simulator
+from convergence import ConvergenceMonitor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Settings used for any key a configuration leaves out (as in agent.run, except
+# that alpha is kept constant, so that sweeping it changes the runs)
+defaults = {
+    'alpha':       0.5,       # learning rate
+    'alpha_decay': 'constant', # 'constant' or 'linear' (ignores alpha), see LearningAgent
+    'decay':       'cosine',  # epsilon schedule, see agent.epsilon_schedules
+    'n_trials':    250,       # training trials the epsilon schedule is spread over
+    'n_test':      40,        # testing trials
+    'tolerance':   0.05,      # epsilon below which testing starts
+    'num_dummies': 100,
+    'grid_size':   (8, 6),
+    'seed':        None,
+    'converge':    False,     # end training early once the Q-table converges, see ConvergenceMonitor
+}
+
+
+def grid(**params):
+    """
+    Return every combination of the given parameter values as a list of
+    configurations, e.g. grid(alpha=[0.2, 0.5], decay=['cosine', 'linear']).
+    """
+
+    names = sorted(params)
+    return [dict(zip(names, values)) for values in itertools.product(*[params[name] for name in names])]
+
+
+def sample(n, rng_seed=None, **params):
+    """
+    Return n configurations, each drawing every parameter at random from its
+    list of values (the run 'seed' included); rng_seed seeds the draws.
+    """
+
+    rng = random.Random(rng_seed)
+    return [dict((name, rng.choice(values)) for name, values in params.iteritems()) for i in xrange(n)]
+
+
+def safety_rating(trials):
+    """
+    Rate the safety of a list of trial rows (Simulator.results), using the
+    same grades as visuals.calculate_safety.
+    """
+
+    actions = [trial['actions'] for trial in trials]
+    n_steps = sum(trial['initial_deadline'] - trial['final_deadline'] for trial in trials)
+    good_ratio = sum(a[0] for a in actions) * 1.0 / n_steps
+
+    if good_ratio == 1: # Perfect driving
+        return "A+"
+    elif sum(a[4] for a in actions) > 0: # Major accident
+        return "F"
+    elif sum(a[3] for a in actions) > 0: # Minor accident
+        return "D"
+    elif sum(a[2] for a in actions) > 0: # Major violation
+        return "C"
+    elif sum(a[1] for a in actions) >= len(trials) / 2: # Minor violation in at least half of the trials
+        return "B"
+    else:
+        return "A"
+
+
+def reliability_rating(trials):
+    """
+    Rate the reliability of a list of trial rows (Simulator.results), using
+    the same grades as visuals.calculate_reliability.
+    """
+
+    success_ratio = sum(trial['success'] for trial in trials) * 1.0 / len(trials)
+
+    if success_ratio == 1: # Always meets deadline
+        return "A+"
+    for grade, threshold in (("A", 0.90), ("B", 0.80), ("C", 0.70), ("D", 0.60)):
+        if success_ratio >= threshold:
+            return grade
+    return "F"
+
+
+def run_config(config):
+    """
+    Train and test one configuration headless and return its results row.
+    """
+
+    settings = dict(defaults)
+    settings.update(config)
+
+    if settings['seed'] is not None:
+        random.seed(settings['seed'])
+        if np is not None:
+            np.random.seed(settings['seed'])
+
+    start = time.time()
+    env = Environment(num_dummies=settings['num_dummies'], grid_size=tuple(settings['grid_size']))
+    agent = env.create_agent(LearningAgent, learning=True, alpha=settings['alpha'],
+                             decay=settings['decay'], alpha_decay=settings['alpha_decay'])
+    env.set_primary_agent(agent, enforce_deadline=True)
+    agent.n_trials = settings['n_trials']
+
+    sim = Simulator(env, update_delay=0, display=False, headless=True)
+    monitor = None
+    if settings['converge']:
+        if np is not None:
+            monitor = ConvergenceMonitor()
+        else:
+            print "run_config(): Unable to import numpy; training without the convergence monitor."
+    sim.run(tolerance=settings['tolerance'], n_test=settings['n_test'], monitor=monitor)
+
+    training = [trial for trial in sim.results if not trial['testing']]
+    testing = [trial for trial in sim.results if trial['testing']]
+
+    row = dict(settings)
+    row['grid_size'] = "{}x{}".format(*settings['grid_size'])
+    row['training_trials'] = len(training)
+    row['success_rate'] = sum(trial['success'] for trial in testing) * 1.0 / len(testing) if testing else None
+    row['safety'] = safety_rating(testing) if testing else None
+    row['reliability'] = reliability_rating(testing) if testing else None
+    row['coverage'] = agent.coverage
+    row['steps'] = sim.n_steps
+    row['seconds'] = time.time() - start
+    return row
+
+
+def _silence():
+    """
+    Pool initializer: keep the workers' trial tables off the terminal.
+    """
+
+    sys.stdout = open(os.devnull, 'w')
+
+
+def run(configs, processes=None, filename="sweep"):
+    """
+    Run every configuration across a pool of 'processes' workers (all cores
+    by default), print a results table and write it to logs/<filename>.csv.
+    Returns the results rows, in the order of 'configs'.
+    """
+
+    configs = [dict(config) for config in configs]
+    for i, config in enumerate(configs):
+        config.setdefault('seed', i) # reproducible, but different for every run
+
+    # The linear alpha decay overrides alpha, so those runs differ only by seed
+    alphas = set(config.get('alpha', defaults['alpha']) for config in configs
+                 if config.get('alpha_decay', defaults['alpha_decay']) == 'linear')
+    if len(alphas) > 1:
+        print "run(): alpha is swept with alpha_decay='linear', which ignores it; use 'constant' to compare alphas."
+
+    pool = multiprocessing.Pool(processes, initializer=_silence)
+    try:
+        results = pool.map(run_config, configs)
+    finally:
+        pool.close()
+        pool.join()
+
+    fields = ['alpha', 'alpha_decay', 'decay', 'n_trials', 'n_test', 'tolerance', 'num_dummies', 'grid_size', 'seed', 'converge',
+              'training_trials', 'success_rate', 'safety', 'reliability', 'coverage', 'steps', 'seconds']
+
+    # Print the table
+    header_format = "{:>6}  {:12}  {:>8}  {:>7}  {:>7}  {:>6}  {:>8}  {:>6}  {:>11}"
+    row_format =    "{:6.2f}  {:12}  {:8d}  {:7d}  {:>7}  {:6}  {:>8}  {:>6}  {:>11}"
+    print header_format.format("Alpha", "Decay", "N trials", "Dummies", "Grid", "Seed", "Success", "Safety", "Reliability")
+    print "-" * 86
+    for row in results:
+        success = "{:.2f}".format(row['success_rate']) if row['success_rate'] is not None else "-"
+        print row_format.format(row['alpha'], row['decay'], row['n_trials'], row['num_dummies'], row['grid_size'],
+                                row['seed'], success, row['safety'] or "-", row['reliability'] or "-")
+
+    # Write the table
+    if not os.path.exists("logs"):
+        os.makedirs("logs")
+    with open(os.path.join("logs", filename + ".csv"), 'wb') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+    return results
+
+
+if __name__ == '__main__':
+    run(grid(alpha=[0.5], alpha_decay=['constant'], decay=['cosine', 'linear', 'exponential'],
+             n_trials=[50, 150, 250], seed=[0, 1]))
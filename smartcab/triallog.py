@@ -0,0 +1,198 @@
+
+"""
+Trial log writer.
+Writes one row of typed columns per trial, and per cab in fleet mode: the
+violation counts and the learning parameters get a column each, instead of
+being stored as stringified dictionaries. AsyncLogWriter moves the writing to a background
+thread.
+"""
+
+import os
+import csv
+import atexit
+import threading
+import Queue
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # the .npz output is unavailable without NumPy
+
+
+# Log columns and their NumPy types
+fields = [
+    ('trial',            'int32'),
+    ('cab',              'int32'),   # 0 for the primary agent, then the fleet in order
+    ('testing',          'bool'),
+    ('epsilon',          'float64'),
+    ('alpha',            'float64'),
+    ('initial_deadline', 'int32'),
+    ('final_deadline',   'int32'),
+    ('net_reward',       'float64'),
+    ('good_actions',     'int32'),   # trial_data['actions'][0]
+    ('minor_violations', 'int32'),   # trial_data['actions'][1]
+    ('major_violations', 'int32'),   # trial_data['actions'][2]
+    ('minor_accidents',  'int32'),   # trial_data['actions'][3]
+    ('major_accidents',  'int32'),   # trial_data['actions'][4]
+    ('success',          'int8'),
+]
+
+# Columns holding the counts of trial_data['actions'], by violation class
+action_fields = ['good_actions', 'minor_violations', 'major_violations', 'minor_accidents', 'major_accidents']
+
+
+def flatten(row):
+    """
+    Turn a trial row with 'actions' and 'parameters' dictionaries (as kept in
+    Simulator.results) into a row of log columns. Rows without a 'cab' are
+    the primary agent's.
+    """
+
+    flat = dict((name, row[name]) for name in ('trial', 'testing', 'initial_deadline',
+                                               'final_deadline', 'net_reward', 'success'))
+    flat['cab'] = row.get('cab', 0)
+    flat['epsilon'] = row['parameters']['e']
+    flat['alpha'] = row['parameters']['a']
+    for violation, name in enumerate(action_fields):
+        flat[name] = row['actions'][violation]
+    return flat
+
+
+class TrialLogWriter(object):
+    """
+    Writes trial rows to a CSV file of typed columns and, optionally, to a
+    NumPy .npz file with one array per column (written on close), which
+    loads much faster than the CSV for long runs.
+    """
+
+    def __init__(self, filename, binary=False):
+        """
+        filename - path of the CSV log
+        binary   - set to True to also write the columns to <filename>.npz
+        """
+        self.filename = filename
+        self.names = [name for name, dtype in fields]
+        self.file = open(filename, 'wb')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.names)
+        self.writer.writeheader()
+
+        self.binary = binary
+        if binary and np is None:
+            print "TrialLogWriter.__init__(): Unable to import numpy; .npz output disabled."
+            self.binary = False
+        self.columns = dict((name, []) for name in self.names) if self.binary else None
+
+
+    def writerow(self, row):
+        """
+        Log one trial row (see flatten).
+        """
+
+        flat = flatten(row)
+        self.writer.writerow(flat)
+        if self.binary:
+            for name in self.names:
+                self.columns[name].append(flat[name])
+
+
+    def flush(self):
+        """
+        Push the rows written so far out to the CSV file.
+        """
+
+        self.file.flush()
+
+
+    def close(self):
+        """
+        Close the CSV log and write the .npz columns, if enabled.
+        """
+
+        self.file.close()
+        if self.binary:
+            arrays = dict((name, np.array(self.columns[name], dtype=dtype)) for name, dtype in fields)
+            np.savez(os.path.splitext(self.filename)[0] + ".npz", **arrays)
+
+
+class AsyncLogWriter(object):
+    """
+    Hands trial rows to a background thread that writes them with another
+    log writer (e.g. a TrialLogWriter), so slow disks do not hold up the
+    simulation. Rows wait in a bounded queue and are written and flushed in
+    batches. close() writes out every queued row; it is also called at exit,
+    so rows are not lost when a run is interrupted.
+    """
+
+    def __init__(self, writer, maxsize=1024, batch_size=64):
+        """
+        writer     - the log writer to write rows with, from the background thread
+        maxsize    - discrete number of rows that may wait; writerow blocks beyond that
+        batch_size - most rows written between two flushes
+        """
+        self.writer = writer
+        self.queue = Queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.error = None   # first exception raised by the writer, re-raised by close
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._drain, name="AsyncLogWriter")
+        self.thread.daemon = True  # never keeps the interpreter alive on its own
+        self.thread.start()
+        atexit.register(self.close)
+
+
+    def writerow(self, row):
+        """
+        Queue one trial row for writing.
+        """
+
+        self.queue.put(dict(row))
+
+
+    def _drain(self):
+        """
+        Background thread: write queued rows in batches until close().
+        """
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            for row in batch:
+                if row is None: # closing
+                    self._flush()
+                    return
+                if self.error is None:
+                    try:
+                        self.writer.writerow(row)
+                    except Exception as e:
+                        self.error = e
+            self._flush()
+
+
+    def _flush(self):
+        if self.error is None:
+            try:
+                self.writer.flush()
+            except Exception as e:
+                self.error = e
+
+
+    def close(self):
+        """
+        Write out every queued row, stop the background thread and close
+        the underlying writer.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
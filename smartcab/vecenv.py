@@ -0,0 +1,378 @@
+"""
+Vectorized environment.
+Runs many independent smartcab worlds in lockstep, with one externally
+driven primary agent per world. The state of every world lives in shared
+NumPy arrays, so each time step is a fixed number of array operations
+however many worlds there are.
+"""
+
+import numpy as np
+
+from environment import Environment, TrafficLight
+from planner import RoutePlanner
+from arraystate import AgentStateArrays
+
+
+class VecEnvironment(object):
+    """
+    K independent worlds advanced in lockstep.
+    Each world follows the rules of an Environment(use_arrays=True): its own
+    traffic lights, its own batched dummy agents, and a primary agent whose
+    actions come from outside. The dummies of all worlds share one
+    AgentStateArrays store, world k holding ids k * num_dummies onwards, and
+    intersections are numbered across worlds as world * n_cells + cell.
+    Observations, rewards and done flags come back stacked in arrays with one
+    row per world. A world whose trial ends is reset straight away, and its
+    trial data is appended to 'trial_results'.
+    """
+
+    # Columns of an observation row
+    fields = ('waypoint', 'light', 'oncoming', 'left', 'right', 'deadline')
+    lights = ['red', 'green']  # light codes
+
+    # Reward for each violation class, as in Environment.compute_reward
+    penalties = np.array([0, -5, -10, -20, -40])
+
+    def __init__(self, n_envs, enforce_deadline=True, num_dummies=100, grid_size=(8, 6)):
+        """
+        n_envs           - discrete number of worlds to simulate
+        enforce_deadline - set to True to enforce a deadline metric in every world
+        num_dummies      - discrete number of dummy agents in each world
+        grid_size        - discrete number of intersections (columns, rows) of each world
+        """
+
+        # Road network, trips and rules shared by every world
+        self.world = Environment(num_dummies=0, grid_size=grid_size)
+        self.n_envs = n_envs
+        self.num_dummies = num_dummies
+        self.grid_size = self.world.grid_size
+        self.enforce_deadline = enforce_deadline
+        self.n_cells = len(self.world.locations)
+        self.valid_actions = Environment.valid_actions
+        self.valid_headings = Environment.valid_headings
+        self.action_codes = dict((action, i) for i, action in enumerate(self.valid_actions))
+        n_headings = len(self.valid_headings)
+        if num_dummies > self.n_cells * n_headings:
+            raise ValueError("VecEnvironment: {} dummies do not fit on {} (intersection, heading) slots".format(
+                num_dummies, self.n_cells * n_headings))
+
+        self.locations = np.array(self.world.locations, dtype=np.int64)
+        self.trip_offsets = np.array(self.world.trip_offsets, dtype=np.int64)
+        self.heading_vectors = np.array(self.valid_headings, dtype=np.int64)
+        self.lo = np.array(self.world.bounds[:2])
+        self.size = np.array(self.grid_size)
+        self.turns = np.zeros(len(self.valid_actions), dtype=np.int64) # heading code change of each action
+        self.turns[self.action_codes['left']] = 1
+        self.turns[self.action_codes['right']] = 3
+
+        # Traffic light schedules, one row per world (see Environment.light_states)
+        self.t = np.zeros(n_envs, dtype=np.int64)
+        self.light_initial = np.random.choice(TrafficLight.valid_states, (n_envs, self.n_cells)).astype(bool)
+        self.light_period = np.random.choice(TrafficLight.valid_periods, (n_envs, self.n_cells))
+
+        # Dummy agents of every world
+        self.dummies = AgentStateArrays(self.world.bounds, self.grid_size, self.valid_headings,
+                                        self.valid_actions, capacity=max(1, n_envs * num_dummies))
+        ids = self.dummies.add_many(n_envs * num_dummies)
+        self.dummies.waypoint[ids] = np.random.randint(1, len(self.valid_actions), len(ids)) #. assumes first is None
+        self.dummy_world = ids // num_dummies if num_dummies else ids
+
+        # Primary agents, one per world
+        self.location = np.zeros((n_envs, 2), dtype=np.int64)
+        self.heading = np.zeros(n_envs, dtype=np.int64)
+        self.destination = np.zeros((n_envs, 2), dtype=np.int64)
+        self.deadline = np.zeros(n_envs, dtype=np.int64)
+        self.done = np.zeros(n_envs, dtype=bool) # primary agent reached its destination or ran out of time
+
+        # Trial data of each world (see Environment.trial_data)
+        self.initial_deadline = np.zeros(n_envs, dtype=np.int64)
+        self.final_deadline = np.zeros(n_envs, dtype=np.int64)
+        self.net_reward = np.zeros(n_envs)
+        self.actions = np.zeros((n_envs, len(self.penalties)), dtype=np.int64) # counts by violation class
+        self.success = np.zeros(n_envs, dtype=np.int64)
+
+        # Waypoint codes by raw (dx, dy) offset and heading, filled in as
+        # offsets are first seen (see RoutePlanner.next_waypoint); -1 if not yet
+        self.waypoints = np.full((2 * self.grid_size[0] - 1, 2 * self.grid_size[1] - 1, n_headings), -1, dtype=np.int8)
+
+        self.testing = False
+        self.trial_results = []
+
+
+    def reset(self, testing=False):
+        """
+        Begin a new trial in every world and return the stacked observations.
+        """
+
+        self.testing = testing
+        self.reset_worlds(np.arange(self.n_envs))
+        return self.sense()
+
+
+    def reset_worlds(self, worlds):
+        """
+        Begin a new trial in the given worlds, as Environment.reset does.
+        """
+
+        n = len(worlds)
+        n_headings = len(self.valid_headings)
+
+        # Lights keep their current state, but their schedules restart at t = 0
+        self.light_initial[worlds] = self.light_states()[worlds]
+        self.t[worlds] = 0
+
+        # Every dummy gets its own (intersection, heading) slot in its world
+        if self.num_dummies:
+            slots = np.random.rand(n, self.n_cells * n_headings).argsort(axis=1)[:, :self.num_dummies]
+            ids = (worlds[:, None] * self.num_dummies + np.arange(self.num_dummies)).ravel()
+            self.dummies.place(ids, slots.ravel())
+
+        # A uniform start plus a uniform valid offset is a uniform valid trip
+        # (see Environment.random_trip)
+        start = self.locations[np.random.randint(self.n_cells, size=n)]
+        offset = self.trip_offsets[np.random.randint(len(self.trip_offsets), size=n)]
+        destination = (start + offset - self.lo) % self.size + self.lo
+        deadline = self.world.compute_dists(start, destination) * 5 # 5 time steps per intersection away #. magic number
+
+        self.location[worlds] = start
+        self.heading[worlds] = np.random.randint(n_headings, size=n)
+        self.destination[worlds] = destination
+        self.deadline[worlds] = deadline
+        self.done[worlds] = False
+
+        self.initial_deadline[worlds] = deadline
+        self.final_deadline[worlds] = deadline
+        self.net_reward[worlds] = 0.0
+        self.actions[worlds] = 0
+        self.success[worlds] = 0
+
+
+    def light_states(self):
+        """
+        Return the state of every traffic light at each world's current time
+        step as an (n_envs, n_cells) array, True where north-south is open.
+        """
+
+        t = self.t[:, None]
+        flipped = (t > 0) & (((t - 1) // self.light_period) % 2 == 1)
+        return self.light_initial != flipped
+
+
+    def waypoint_codes(self):
+        """
+        Return the code of every primary agent's next waypoint.
+        """
+
+        dx = self.destination[:, 0] - self.location[:, 0] + self.grid_size[0] - 1
+        dy = self.destination[:, 1] - self.location[:, 1] + self.grid_size[1] - 1
+        codes = self.waypoints[dx, dy, self.heading]
+        missing = codes < 0
+        if missing.any():
+            for key in set(zip(dx[missing], dy[missing], self.heading[missing])):
+                delta = (key[0] - self.grid_size[0] + 1, key[1] - self.grid_size[1] + 1)
+                waypoint = RoutePlanner.compute_waypoint(delta, self.valid_headings[key[2]], self.grid_size)
+                self.waypoints[key] = self.action_codes[waypoint]
+            codes = self.waypoints[dx, dy, self.heading]
+        return codes.astype(np.int64)
+
+
+    def sensors(self):
+        """
+        Return what every primary agent senses, as arrays of the light (True
+        if green) and the waypoint codes of the oncoming car and the cars on
+        the left and right (0 if none), with the same precedence as
+        Environment.sense when several cars share an approach.
+        """
+
+        K, D = self.n_envs, self.num_dummies
+        lights = self.light_states()
+        cell = (self.location[:, 0] - self.lo[0]) * self.grid_size[1] + (self.location[:, 1] - self.lo[1])
+        green = lights[np.arange(K), cell] == (self.heading % 2 == 1)
+
+        oncoming = np.zeros(K, dtype=np.int64)
+        left = np.zeros(K, dtype=np.int64)
+        right = np.zeros(K, dtype=np.int64)
+        if not D:
+            return green, oncoming, left, right
+
+        codes = self.action_codes
+        rows = np.arange(K)
+        order = np.arange(D)
+        waypoints = self.dummies.waypoint[:K * D].reshape(K, D).astype(np.int64)
+        here = self.dummies.cells().reshape(K, D) == cell[:, None]
+
+        # Heading of each dummy relative to the primary agent's:
+        # 2 oncoming, 1 coming from the right, 3 from the left
+        relative = (self.dummies.heading[:K * D].reshape(K, D) - self.heading[:, None]) % len(self.valid_headings)
+
+        def last(mask):
+            # Waypoint of the last car in the mask, as later cars override earlier ones
+            i = np.where(mask, order, -1).max(axis=1)
+            return np.where(i >= 0, waypoints[rows, i], 0)
+
+        # Oncoming: 'left' sticks, otherwise the last car
+        mask = here & (relative == 2)
+        oncoming = np.where((mask & (waypoints == codes['left'])).any(axis=1), codes['left'], last(mask))
+
+        # Right: the first 'forward' or 'left' sticks, otherwise the last car
+        mask = here & (relative == 1)
+        first = np.where(mask & ((waypoints == codes['forward']) | (waypoints == codes['left'])), order, D).min(axis=1)
+        right = np.where(first < D, waypoints[rows, first % D], last(mask))
+
+        # Left: 'forward' sticks, otherwise the last car
+        mask = here & (relative == 3)
+        left = np.where((mask & (waypoints == codes['forward'])).any(axis=1), codes['forward'], last(mask))
+
+        return green, oncoming, left, right
+
+
+    def sense(self):
+        """
+        Return the primary agent's observation in every world as an
+        (n_envs, len(fields)) integer array. Actions are coded by their
+        index in valid_actions, and lights as 0 (red) or 1 (green).
+        """
+
+        green, oncoming, left, right = self.sensors()
+        return np.column_stack((self.waypoint_codes(), green, oncoming, left, right, self.deadline))
+
+
+    def act(self, actions):
+        """
+        Perform one action per world for the primary agents, without advancing
+        time, by the rules of Environment.act. 'actions' holds either actions
+        or their codes. Worlds whose primary agent has finished its trial
+        ignore their action.
+        Returns the rewards as an array.
+        """
+
+        codes = self.action_codes
+        if isinstance(actions, np.ndarray) and actions.dtype.kind in 'iu':
+            action = actions.astype(np.int64)
+        else:
+            action = np.array([codes[a] if a is None or isinstance(a, basestring) else a for a in actions], dtype=np.int64)
+        active = ~self.done
+
+        green, oncoming, left, right = self.sensors()
+        waypoint = self.waypoint_codes()
+        forward, turn_left, turn_right = codes['forward'], codes['left'], codes['right']
+
+        # Classify the action, see Environment.act for the violation classes
+        cross_traffic = (left == forward) | (right == forward)
+        violation = np.select(
+            [action == forward, action == turn_left, action == turn_right],
+            [np.where(green, 0, np.where(cross_traffic, 4, 2)),
+             np.where(green, np.where((oncoming == turn_right) | (oncoming == forward), 3, 0),
+                             np.where(cross_traffic | (oncoming == turn_right), 4, 2)),
+             np.where(~green & (left == forward), 3, 0)],
+            np.where(green & (oncoming != turn_left), 1, 0)) # no action
+
+        # Score the action before the agent moves, as the waypoint depends on its location
+        reward = 2 * np.random.rand(self.n_envs) - 1
+        if self.enforce_deadline:
+            with np.errstate(divide='ignore', invalid='ignore'): # only finished worlds can divide by 0
+                fnc = self.t * 1.0 / (self.t + self.deadline)
+            penalty = (10 ** fnc - 1) / 9 # gradient 10, see Environment.compute_reward
+        else:
+            penalty = 0.0
+        correct = (action == waypoint) | ((action == 0) & ~green)
+        reward += np.where(violation == 0, np.where(correct, 2, 1) - penalty, self.penalties[violation])
+        reward[~active] = 0.0
+
+        # Move the agents that made a valid move
+        moving = active & (violation == 0) & (action != 0)
+        heading = (self.heading[moving] + self.turns[action[moving]]) % len(self.valid_headings)
+        self.location[moving] = (self.location[moving] + self.heading_vectors[heading] - self.lo) % self.size + self.lo
+        self.heading[moving] = heading
+
+        # Did the agent reach the goal after a valid move?
+        arrived = active & (self.location == self.destination).all(axis=1)
+        self.success[arrived & (self.deadline >= 0)] = 1
+        self.done |= arrived
+
+        # Update metrics
+        worlds = np.flatnonzero(active)
+        self.final_deadline[worlds] = self.deadline[worlds] - 1
+        self.net_reward[worlds] += reward[worlds]
+        np.add.at(self.actions, (worlds, violation[worlds]), 1)
+        return reward
+
+
+    def advance(self):
+        """
+        Finish a time step in every world once the primary agents have acted:
+        move the dummies, count down the deadlines and advance the time, as
+        Environment.advance does.
+        """
+
+        # Dummies, with one intersection numbering across all worlds
+        store = self.dummies
+        if store.n:
+            n_headings = len(self.valid_headings)
+            cells = self.dummy_world * self.n_cells + store.cells()
+            headings = store.heading[:store.n].astype(np.int64)
+            waypoints = store.waypoint[:store.n]
+            green = self.light_states().ravel()[cells] == (headings % 2 == 1)
+            visible = np.ones(store.n, dtype=bool)
+            moving = np.flatnonzero(Environment.safe_moves(cells, headings, waypoints, green, visible, self.n_envs * self.n_cells))
+            store.move(moving, (headings[moving] + self.turns[waypoints[moving]]) % n_headings)
+            store.waypoint[moving] = np.random.randint(1, len(self.valid_actions), len(moving)) #. assumes first is None
+
+        # Count down the deadlines of the agents still on the road
+        active = ~self.done
+        self.deadline[active] -= 1
+        late = self.deadline <= self.world.hard_time_limit
+        if self.enforce_deadline:
+            late |= self.deadline <= 0
+        self.done |= active & late
+
+        self.t += 1
+
+
+    def step(self, actions):
+        """
+        Act in every world and advance them all by one time step.
+        Returns stacked (observations, rewards, dones). Worlds that finished
+        their trial are reset before the observations are taken.
+        """
+
+        rewards = self.act(actions)
+        self.advance()
+        dones = self.done.copy()
+        worlds = np.flatnonzero(dones)
+        if len(worlds):
+            for k in worlds:
+                self.trial_results.append(self.trial_data(k))
+            self.reset_worlds(worlds)
+        return self.sense(), rewards, dones
+
+
+    def trial_data(self, k):
+        """
+        Return the data of world k's current trial, with the keys of
+        Environment.trial_data.
+        """
+
+        return {
+            'testing': self.testing,
+            'initial_deadline': int(self.initial_deadline[k]),
+            'final_deadline': int(self.final_deadline[k]),
+            'net_reward': float(self.net_reward[k]),
+            'actions': dict(enumerate(self.actions[k].tolist())),
+            'parameters': {'e': None, 'a': None},
+            'success': int(self.success[k]),
+            'coverage': 0,
+        }
+
+
+    def decode(self, observation):
+        """
+        Turn one observation row back into a dictionary of named inputs.
+        """
+
+        values = dict(zip(self.fields, observation))
+        for name in ('waypoint', 'oncoming', 'left', 'right'):
+            values[name] = self.valid_actions[values[name]]
+        values['light'] = self.lights[values['light']]
+        values['deadline'] = int(values['deadline'])
+        return values
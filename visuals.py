@@ -17,23 +17,98 @@ import os
 import ast
 
 
+# Trial log columns with the counts of each violation class, indexed like
+# the 'actions' dictionary of older logs
+action_columns = ['good_actions', 'minor_violations', 'major_violations', 'minor_accidents', 'major_accidents']
+
+
+def add_trial_columns(data):
+	""" Adds the typed violation and parameter columns to a log written before
+	the simulator logged them, by parsing its 'actions' and 'parameters' columns once. """
+
+	if 'actions' in data.columns:
+		actions = data['actions'].apply(ast.literal_eval)
+		for violation, name in enumerate(action_columns):
+			data[name] = actions.apply(lambda x: x[violation])
+		parameters = data['parameters'].apply(ast.literal_eval)
+		data['epsilon'] = parameters.apply(lambda x: x['e'])
+		data['alpha'] = parameters.apply(lambda x: x['a'])
+	return data
+
+
+# Loaded trial logs, by path: (modification time, data frame)
+_trials_cache = dict()
+
+
+def load_trials(csv, cab=0):
+	""" Loads the trials of one cab (0 for the primary agent, None for every cab of
+	a fleet) from a trial log in logs/, together with their derived columns.
+	The .npz columns written next to the log are read instead of the csv when they
+	are up to date (or the csv is missing), and the result is cached until the file
+	changes. Each call returns a new data frame, so callers may add columns to it. """
+
+	path = os.path.join("logs", csv)
+	npz = os.path.splitext(path)[0] + ".npz"
+	if os.path.exists(npz) and (not os.path.exists(path) or os.path.getmtime(npz) >= os.path.getmtime(path)):
+		source = npz
+	else:
+		source = path
+
+	mtime = os.path.getmtime(source)
+	cached = _trials_cache.get(source)
+	if cached is not None and cached[0] == mtime:
+		return select_cab(cached[1], cab)
+
+	if source == npz:
+		columns = np.load(npz)
+		data = pd.DataFrame(dict((name, columns[name]) for name in columns.files))
+		columns.close()
+	else:
+		data = add_trial_columns(pd.read_csv(path))
+	if 'cab' not in data.columns: # single-cab log
+		data['cab'] = 0
+
+	# Create additional features, over the trials of each cab
+	rolling = lambda column: column.groupby(data['cab']).transform(lambda x: x.rolling(window=10, center=False).mean())
+	data['steps'] = data['initial_deadline'] - data['final_deadline']
+	data['average_reward'] = rolling(data['net_reward'] / data['steps'])
+	data['reliability_rate'] = rolling(data['success']*100)  # compute avg. net reward with window=10
+	data['good'] = rolling(data['good_actions'] * 1.0 / data['steps'])
+	data['minor'] = rolling(data['minor_violations'] * 1.0 / data['steps'])
+	data['major'] = rolling(data['major_violations'] * 1.0 / data['steps'])
+	data['minor_acc'] = rolling(data['minor_accidents'] * 1.0 / data['steps'])
+	data['major_acc'] = rolling(data['major_accidents'] * 1.0 / data['steps'])
+
+	_trials_cache[source] = (mtime, data)
+	return select_cab(data, cab)
+
+
+def select_cab(data, cab):
+	""" Returns the rows of one cab of a loaded trial log, or every row if cab is None,
+	as a new data frame. """
+
+	if cab is None:
+		return data.copy()
+	return data[data['cab'] == cab].reset_index(drop=True)
+
+
 def calculate_safety(data):
-	""" Calculates the safety rating of the smartcab during testing. """
+	""" Calculates the safety rating of the smartcab during testing,
+	from trials loaded by load_trials. """
 
-	good_ratio = data['good_actions'].sum() * 1.0 / \
-	(data['initial_deadline'] - data['final_deadline']).sum()
+	good_ratio = data['good_actions'].sum() * 1.0 / data['steps'].sum()
 
 	if good_ratio == 1: # Perfect driving
 		return ("A+", "green")
 	else: # Imperfect driving
-		if data['actions'].apply(lambda x: ast.literal_eval(x)[4]).sum() > 0: # Major accident
+		if data['major_accidents'].sum() > 0: # Major accident
 			return ("F", "red")
-		elif data['actions'].apply(lambda x: ast.literal_eval(x)[3]).sum() > 0: # Minor accident
+		elif data['minor_accidents'].sum() > 0: # Minor accident
 			return ("D", "#EEC700")
-		elif data['actions'].apply(lambda x: ast.literal_eval(x)[2]).sum() > 0: # Major violation
+		elif data['major_violations'].sum() > 0: # Major violation
 			return ("C", "#EEC700")
 		else: # Minor violation
-			minor = data['actions'].apply(lambda x: ast.literal_eval(x)[1]).sum()
+			minor = data['minor_violations'].sum()
 			if minor >= len(data)/2: # Minor violation in at least half of the trials
 				return ("B", "green")
 			else:
@@ -60,34 +135,17 @@ def calculate_reliability(data):
 			return ("F", "red")
 
 
-def plot_trials(csv):
-	""" Plots the data from logged metrics during a simulation."""
+def plot_trials(csv, cab=0):
+	""" Plots the data from logged metrics during a simulation, for one cab
+	(0 for the primary agent) of a fleet. """
 
-	data = pd.read_csv(os.path.join("logs", csv))
+	data = load_trials(csv, cab)
 
 	if len(data) < 10:
 		print "Not enough data collected to create a visualization."
 		print "At least 20 trials are required."
 		return
 	
-	# Create additional features
-	data['average_reward'] = (data['net_reward'] / (data['initial_deadline'] - data['final_deadline'])).rolling(window=10, center=False).mean()
-	data['reliability_rate'] = (data['success']*100).rolling(window=10, center=False).mean()  # compute avg. net reward with window=10
-	data['good_actions'] = data['actions'].apply(lambda x: ast.literal_eval(x)[0])
-	data['good'] = (data['good_actions'] * 1.0 / \
-		(data['initial_deadline'] - data['final_deadline'])).rolling(window=10, center=False).mean()
-	data['minor'] = (data['actions'].apply(lambda x: ast.literal_eval(x)[1]) * 1.0 / \
-		(data['initial_deadline'] - data['final_deadline'])).rolling(window=10, center=False).mean()
-	data['major'] = (data['actions'].apply(lambda x: ast.literal_eval(x)[2]) * 1.0 / \
-		(data['initial_deadline'] - data['final_deadline'])).rolling(window=10, center=False).mean()
-	data['minor_acc'] = (data['actions'].apply(lambda x: ast.literal_eval(x)[3]) * 1.0 / \
-		(data['initial_deadline'] - data['final_deadline'])).rolling(window=10, center=False).mean()
-	data['major_acc'] = (data['actions'].apply(lambda x: ast.literal_eval(x)[4]) * 1.0 / \
-		(data['initial_deadline'] - data['final_deadline'])).rolling(window=10, center=False).mean()
-	data['epsilon'] = data['parameters'].apply(lambda x: ast.literal_eval(x)['e']) 
-	data['alpha'] = data['parameters'].apply(lambda x: ast.literal_eval(x)['a']) 
-
-
 	# Create training and testing subsets
 	training_data = data[data['testing'] == False]
 	testing_data = data[data['testing'] == True]